@@ -0,0 +1,207 @@
+##### Libraries #####
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from main import BACKEND, AGENT_BACKENDS, start_model
+from libs.cancel import CancelToken, GenerationCancelled, call_with_token
+from libs.logs import REQUEST_ID, get_logger
+
+
+
+
+
+##### Parameters #####
+LOG_LEVEL: int = logging.INFO
+PROMPT_KEYS: List[str] = [ "prompt", "content", "message" ]
+
+
+
+
+
+##### Loggers #####
+LOGGER = get_logger("Batch", LOG_LEVEL)
+
+
+
+
+
+##### Functions #####
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Answer the prompts of a JSONL file without going through Discord.")
+    parser.add_argument("--input", default="requests.jsonl")
+    parser.add_argument("--output", default="responses.jsonl",
+                        help="Appended as results arrive; doubles as the checkpoint to resume from.")
+    parser.add_argument("--backend", default=BACKEND)
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once.")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Prompts per generate() call for Hugging Face models that support batching.")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Deadline of a single request (secs), of a whole batch when batching.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Also redo the records that failed in a previous run.")
+    return parser.parse_args()
+
+
+def read_records(path: str, done: Set[str]) -> Iterator[Tuple[str, str]]:
+    """ Stream (id, prompt) pairs, skipping the IDs already answered. """
+    with open(path, 'r', encoding="utf-8") as file:
+        for line_num, line in enumerate(file, start=1):
+            if not line.strip(): continue
+            record: Dict = json.loads(line)
+            record_id = str(record.get("id", record.get("request_id", line_num)))
+            if record_id in done: continue
+            prompt = next((record[key] for key in PROMPT_KEYS if key in record), None)
+            if prompt is None:
+                # Backlog style records: { "title": ..., "body": ... }
+                prompt = '\n\n'.join(record[key] for key in [ "title", "body" ] if record.get(key))
+            yield record_id, prompt
+
+
+def read_checkpoint(path: str, retry_failed: bool) -> Set[str]:
+    done = set()
+    if not os.path.exists(path): return done
+    with open(path, 'r', encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Torn last line of an interrupted run
+            if retry_failed and result.get("error"): continue
+            done.add(result["id"])
+    return done
+
+
+def supports_batching(model: Any) -> bool:
+    """ `HfBaseModel.batch` answers the prompts one by one, only an override generates them together. """
+    batch = getattr(type(model), "batch", None)
+    if batch is None: return False
+    from libs.hf import HfBaseModel  # Already imported, only Hugging Face models have `batch`
+    return batch is not HfBaseModel.batch
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values: return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered))) - 1))]
+
+
+
+
+
+##### Classes #####
+class BatchRunner(object):
+    def __init__(self, output_path: str, timeout: float) -> None:
+        self.output = open(output_path, 'a', encoding="utf-8")
+        self.timeout = timeout
+        self.latencies: List[float] = []
+        self.failed = 0
+        self.output_chars = 0
+
+    def write(self, record_id: str, response: Any = None, error: Optional[str] = None, latency: float = 0.0) -> None:
+        result = { "id": record_id, "response": response, "error": error, "latency_secs": round(latency, 3) }
+        self.output.write(json.dumps(result, ensure_ascii=False) + '\n')
+        self.output.flush()
+        if error:
+            self.failed += 1
+            LOGGER.warning(f"Request \"{record_id}\" failed: {error}")
+        else:
+            self.latencies.append(latency)
+            self.output_chars += len(response) if isinstance(response, str) else len(json.dumps(response))
+
+    async def call(self, func, *args, **kwargs) -> Tuple[Any, Optional[str]]:
+        token = CancelToken(self.timeout)
+        # The deadline alone is only noticed when polled, the timer also wakes blocked waits
+        timer = asyncio.get_running_loop().call_later(
+            self.timeout, token.cancel, "Deadline exceeded.") if self.timeout > 0 else None
+        try:
+            return await asyncio.to_thread(call_with_token, token, func, *args, **kwargs), None
+        except GenerationCancelled as ex:
+            return None, ex.reason
+        except Exception as ex:
+            return None, f"{type(ex).__name__}: {ex}"
+        finally:
+            if timer is not None: timer.cancel()
+
+    async def run_concurrent(
+            self, records: Iterator[Tuple[str, str]], model: Any, concurrency: int, agent: bool) -> None:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+        # Records are independent, so the agent answers each in a one-off conversation
+        kwargs = { "conversation": None } if agent else {}
+
+        async def produce() -> None:
+            for record in records: await queue.put(record)
+            for _ in range(concurrency): await queue.put(None)
+
+        async def consume() -> None:
+            while (record := await queue.get()) is not None:
+                record_id, prompt = record
+                REQUEST_ID.set(record_id)
+                start = time.perf_counter()
+                response, error = await self.call(model, prompt, **kwargs)
+                self.write(record_id, response, error, time.perf_counter() - start)
+
+        await asyncio.gather(produce(), *[ consume() for _ in range(concurrency) ])
+
+    async def run_batched(self, records: Iterator[Tuple[str, str]], model: Any, batch_size: int) -> None:
+        """ One `model.batch` call per `batch_size` records, the deadline and the latency are per batch. """
+        while chunk := list(itertools.islice(records, batch_size)):
+            start = time.perf_counter()
+            responses, error = await self.call(model.batch, [ prompt for _, prompt in chunk ])
+            latency = time.perf_counter() - start
+            for index, (record_id, _) in enumerate(chunk):
+                self.write(record_id, responses[index] if responses else None, error, latency)
+
+    def summary(self, wall: float, skipped: int) -> str:
+        done = len(self.latencies)
+        return '\n'.join([
+            f"Succeeded  : {done}",
+            f"Failed     : {self.failed}",
+            f"Skipped    : {skipped} (already in the checkpoint)",
+            f"Wall time  : {wall:.1f} secs",
+            f"Throughput : {done / wall if wall else 0:.2f} prompts/s, {self.output_chars / wall if wall else 0:.0f} chars/s",
+            f"Latency    : p50 {percentile(self.latencies, 50):.2f} secs, p99 {percentile(self.latencies, 99):.2f} secs",
+        ])
+
+    def close(self) -> None:
+        self.output.close()
+
+
+
+
+
+##### Main #####
+async def amain(args: argparse.Namespace) -> int:
+    done = read_checkpoint(args.output, args.retry_failed)
+    if done: LOGGER.info(f"Resuming: {len(done)} request(s) already answered in \"{args.output}\".")
+    records = read_records(args.input, done)
+
+    loader = start_model(args.backend)
+    await loader.wait_ready()
+    model = loader.model
+
+    runner = BatchRunner(args.output, args.timeout)
+    start = time.perf_counter()
+    try:
+        if args.batch_size > 1 and supports_batching(model):
+            await runner.run_batched(records, model, args.batch_size)
+        else:
+            await runner.run_concurrent(records, model, args.concurrency, args.backend in AGENT_BACKENDS)
+    finally:
+        runner.close()
+        loader.close()
+    LOGGER.info("Batch finished:\n" + runner.summary(time.perf_counter() - start, len(done)))
+    return 1 if runner.failed else 0
+
+
+
+
+
+##### Execution #####
+if __name__ == "__main__":
+    sys.exit(asyncio.run(amain(parse_args())))
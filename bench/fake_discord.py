@@ -0,0 +1,58 @@
+##### Libraries #####
+import time
+import asyncio
+import itertools
+from typing import Any, List, Optional, Tuple
+
+
+
+
+
+##### Parameters #####
+_IDS = itertools.count(1_000_000)
+
+
+
+
+
+##### Classes #####
+class FakeAuthor(object):
+    def __init__(self, user_id: int, name: str = "bench-user") -> None:
+        self.id = user_id
+        self.name = name
+
+
+
+class FakeChannel(object):
+    """ Records what the bot sends instead of calling the Discord API. """
+    def __init__(self, channel_id: Optional[int] = None, send_latency: float = 0.0) -> None:
+        self.id = channel_id or next(_IDS)
+        self.send_latency = send_latency
+        # (time.perf_counter(), content length, attachment bytes)
+        self.sent: List[Tuple[float, int, int]] = []
+
+    async def send(self, content: Optional[str] = None, **kwargs) -> "FakeMessage":
+        if self.send_latency: await asyncio.sleep(self.send_latency)
+        files = kwargs.get("files") or ([ kwargs["file"] ] if kwargs.get("file") else [])
+        attachment_bytes = sum(len(file.fp.getvalue()) for file in files if hasattr(file.fp, "getvalue"))
+        self.sent.append((time.perf_counter(), len(content or ''), attachment_bytes))
+        return FakeMessage(content or '', FakeAuthor(0, "bot"), self)
+
+
+
+class FakeMessage(object):
+    def __init__(
+            self,
+            content: str,
+            author: FakeAuthor,
+            channel: FakeChannel,
+            attachments: Optional[List[Any]] = None,
+        ) -> None:
+        self.id = next(_IDS)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.attachments = attachments or []
+
+    def __repr__(self) -> str:
+        return f"<FakeMessage id={self.id} channel={self.channel.id} len={len(self.content)}>"
@@ -0,0 +1,169 @@
+##### Libraries #####
+import re
+import json
+import time
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+
+
+
+
+
+##### Parameters #####
+FN_RESULT: str = "✿RESULT✿"  # Qwen-Agent's marker of a tool result
+# A script is a list of steps. The step served is the number of tool results
+# from the last user message on, so a function call step is followed by the
+# next step once the agent has sent the tool result back.
+DEFAULT_SCRIPT: List[Dict] = [{ "content": "Sure! Here is the answer:\n```py\nprint('Hello, world!')\n```" }]
+TOOL_CALL_SCRIPT: List[Dict] = [
+    { "function_call": { "name": "project_manager",
+                         "arguments": json.dumps({ "operate": "walk" }) } },
+    { "content": "The workspace has been scanned." },
+]
+
+
+
+
+
+##### Functions #####
+def split_tokens(text: str) -> List[str]:
+    """ Rough stand-in for a tokenizer: words and whitespace, split again every 4 chars. """
+    return [ piece[i:i+4] for piece in re.findall(r"\s+|\S+", text) for i in range(0, len(piece), 4) ]
+
+
+def message_text(message: Dict) -> str:
+    content = message.get("content") or ''
+    if isinstance(content, str): return content
+    return ''.join(item.get("text") or '' for item in content if isinstance(item, dict))
+
+
+def format_function_call(function_call: Dict) -> str:
+    # Qwen-Agent parses tool calls out of the plain completion text
+    return f"✿FUNCTION✿: {function_call['name']}\n✿ARGS✿: {function_call['arguments']}\n{FN_RESULT}"
+
+
+
+
+
+##### Classes #####
+class FakeVllmServer(object):
+    """
+    Local stand-in for the vLLM OpenAI-compatible server.
+
+    Serves `/v1/models`, `/v1/chat/completions` and `/v1/completions`,
+    streamed or not, waiting `latency` secs before the first token and then
+    emitting `tokens_per_sec` tokens per second.
+    """
+    def __init__(
+            self,
+            port: int = 0,
+            model_name: str = "fake-model",
+            latency: float = 0.2,
+            tokens_per_sec: float = 50.0,
+            script: Optional[List[Dict]] = None,
+        ) -> None:
+        self.model_name = model_name
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.script = script or DEFAULT_SCRIPT
+        self.request_count = 0
+        self.disconnects = 0
+        # Requests served per script step, a stalled script keeps hitting the same step
+        self.steps: collections.Counter = collections.Counter()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                self.send_json({ "object": "list", "data": [{ "id": server.model_name, "object": "model" }] })
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                chat = self.path.endswith("/chat/completions")
+                text = server.reply_text(body.get("messages", []))
+                if body.get("stream"):
+                    self.send_stream(text, chat)
+                else:
+                    time.sleep(server.latency + len(split_tokens(text)) / server.tokens_per_sec)
+                    self.send_json(server.completion(text, chat))
+
+            def send_json(self, payload: Dict) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_stream(self, text: str, chat: bool) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for event in server.stream_events(text, chat):
+                        data = f"data: {event}\n\n".encode("utf-8")
+                        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client closed the stream, i.e. the request was cancelled
+                    server.disconnects += 1
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def reply_text(self, messages: List[Dict]) -> str:
+        self.request_count += 1
+        # Qwen-Agent flattens tool results into the text as "✿RESULT✿: ...\n✿RETURN✿",
+        # appended to the last user or assistant message depending on its version
+        step = 0
+        for message in reversed(messages):
+            step += message_text(message).count(f"{FN_RESULT}:")
+            if message.get("role") == "user": break
+        step = min(step, len(self.script) - 1)
+        self.steps[step] += 1
+        entry = self.script[step]
+        if "function_call" in entry: return format_function_call(entry["function_call"])
+        return entry["content"]
+
+    def completion(self, text: str, chat: bool) -> Dict:
+        choice = { "index": 0, "finish_reason": "stop" }
+        if chat: choice["message"] = { "role": "assistant", "content": text }
+        else:    choice["text"] = text
+        return {
+            "id": f"cmpl-{self.request_count}", "object": "chat.completion" if chat else "text_completion",
+            "created": int(time.time()), "model": self.model_name, "choices": [ choice ],
+            "usage": { "prompt_tokens": 0, "completion_tokens": len(split_tokens(text)),
+                       "total_tokens": len(split_tokens(text)) },
+        }
+
+    def stream_events(self, text: str, chat: bool) -> Iterator[str]:
+        time.sleep(self.latency)
+        for token in split_tokens(text):
+            time.sleep(1 / self.tokens_per_sec)
+            delta = { "delta": { "content": token } } if chat else { "text": token }
+            yield json.dumps({ "id": "cmpl-fake", "object": "chat.completion.chunk" if chat else "text_completion",
+                               "created": int(time.time()), "model": self.model_name,
+                               "choices": [{ "index": 0, "finish_reason": None, **delta }] })
+        finish = { "delta": {} } if chat else { "text": '' }
+        yield json.dumps({ "id": "cmpl-fake", "object": "chat.completion.chunk" if chat else "text_completion",
+                           "created": int(time.time()), "model": self.model_name,
+                           "choices": [{ "index": 0, "finish_reason": "stop", **finish }] })
+        yield "[DONE]"
+
+    def start(self) -> "FakeVllmServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,251 @@
+"""
+Offline end-to-end benchmark: no GPU, Discord token or docker container needed.
+
+Starts `FakeVllmServer`, then drives either `DiscordBot.on_message` with fake
+Discord objects (`--target bot`) or the backend model directly
+(`--target model`), and reports throughput, latency percentiles and memory.
+
+    python -m bench.run --scenario concurrent --channels 8 --messages 4
+    python -m bench.run --scenario long_history --backend vllm_qwen --save bench/last.json
+    python -m bench.run --scenario large_output --baseline bench/last.json
+    python -m bench.run --scenario cancel --target model --cancel-after 0.5
+
+`vllm_lc` needs the tokenizer of `--model-name` in the local Hugging Face cache.
+"""
+##### Libraries #####
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+from typing import Dict, List
+from .fake_vllm import FakeVllmServer, DEFAULT_SCRIPT, TOOL_CALL_SCRIPT
+from .fake_discord import FakeAuthor, FakeChannel, FakeMessage
+
+
+
+
+
+##### Parameters #####
+SCENARIOS: List[str] = [ "concurrent", "long_history", "large_output", "tool_call", "large_tool_output", "cancel" ]
+USER_ID  : int = 4242
+# File the large_tool_output scenario has the agent read back through project_manager
+TOOL_OUTPUT_PROJECT : str = "bench"
+TOOL_OUTPUT_FILENAME: str = "tool_output.txt"
+
+
+
+
+
+##### Functions #####
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Discord bot.")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="concurrent")
+    parser.add_argument("--target", choices=[ "bot", "model" ], default="bot")
+    parser.add_argument("--backend", choices=[ "vllm_qwen", "vllm_lc" ], default="vllm_qwen")
+    parser.add_argument("--model-name", default="fake-model")
+    parser.add_argument("--channels", type=int, default=4, help="Concurrent channels.")
+    parser.add_argument("--messages", type=int, default=4, help="Messages per channel.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Server time to first token (secs).")
+    parser.add_argument("--tps", type=float, default=200.0, help="Server tokens per second.")
+    parser.add_argument("--history-turns", type=int, default=200, help="Pre-filled turns for long_history.")
+    parser.add_argument("--output-chars", type=int, default=30000,
+                        help="Reply size for large_output, tool result size for large_tool_output.")
+    parser.add_argument("--cancel-after", type=float, default=1.0,
+                        help="Secs before the cancel scenario withdraws each request.")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="Fake Discord send latency (secs).")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for main.py, e.g. MAX_ACTIVE_REQUESTS=4.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report the Python heap peak.")
+    parser.add_argument("--save", help="Write the report as JSON.")
+    parser.add_argument("--baseline", help="Fail if p99 latency or throughput regressed against this report.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+def build_script(args: argparse.Namespace) -> List[Dict]:
+    if args.scenario == "tool_call":
+        return TOOL_CALL_SCRIPT
+    if args.scenario == "large_tool_output":
+        return [
+            { "function_call": { "name": "project_manager", "arguments": json.dumps({
+                "operate": "read", "project name": TOOL_OUTPUT_PROJECT, "filename": TOOL_OUTPUT_FILENAME }) } },
+            { "content": "The file has been read." },
+        ]
+    # A reply long enough to still be streaming when the cancel scenario withdraws it
+    if args.scenario in ("large_output", "cancel"):
+        block = "```py\n" + "print('benchmark line with some padding')\n" * 40 + "```\n"
+        text = "Here is the generated project:\n"
+        while len(text) < args.output_chars: text += block
+        return [{ "content": text }]
+    return DEFAULT_SCRIPT
+
+
+def write_tool_output(chars: int) -> None:
+    """ Fixture read by the large_tool_output script, so the tool result is `chars` long. """
+    from libs import PROJECTS_ROOT
+    project_dir = os.path.join(PROJECTS_ROOT, TOOL_OUTPUT_PROJECT)
+    os.makedirs(project_dir, exist_ok=True)
+    line = "tool output line with some padding to look like a log\n"
+    with open(os.path.join(project_dir, TOOL_OUTPUT_FILENAME), 'w', encoding="utf-8") as file:
+        file.write((line * (chars // len(line) + 1))[:chars])
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values: return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered))) - 1))]
+
+
+def prefill_history(model, conversation: str, turns: int) -> None:
+    if not hasattr(model, "history"): return
+    history = model.history(conversation)
+    for turn in range(turns):
+        history.append({ "role": "user", "content": f"Earlier request #{turn}: write a helper function." })
+        history.append({ "role": "assistant", "content": "```py\ndef helper():\n    return 42\n```" })
+
+
+async def run_bot(main, model, args: argparse.Namespace) -> Dict:
+    bot = main.DiscordBot(model=model, backend=args.backend, intents=main.discord.Intents.default())
+    author = FakeAuthor(USER_ID)
+    channels = [ FakeChannel(send_latency=args.send_latency) for _ in range(args.channels) ]
+    if args.scenario == "long_history":
+        for channel in channels: prefill_history(model.model, str(channel.id), args.history_turns)
+    latencies: List[float] = []
+
+    async def cancel_later(channel: FakeChannel) -> None:
+        await asyncio.sleep(args.cancel_after)
+        await bot.on_message(FakeMessage("!Cancel", author, channel))
+
+    async def drive(channel: FakeChannel) -> None:
+        for message_id in range(args.messages):
+            dc_msg = FakeMessage(f"Request {message_id}: please write a quick sort.", author, channel)
+            canceller = asyncio.create_task(cancel_later(channel)) if args.scenario == "cancel" else None
+            start = time.perf_counter()
+            await bot.on_message(dc_msg)
+            latencies.append(time.perf_counter() - start)
+            if canceller is not None: await canceller
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ drive(channel) for channel in channels ])
+    wall = time.perf_counter() - start
+    return {
+        "latencies": latencies, "wall": wall,
+        "sent_messages": sum(len(channel.sent) for channel in channels),
+        "sent_chars": sum(length for channel in channels for _, length, _ in channel.sent),
+        "sent_attachment_bytes": sum(size for channel in channels for _, _, size in channel.sent),
+    }
+
+
+async def run_model(model, args: argparse.Namespace) -> Dict:
+    from libs.cancel import CancelToken, GenerationCancelled, call_with_token
+    if args.scenario == "long_history": prefill_history(model.model, "default", args.history_turns)
+    latencies: List[float] = []
+    cancelled: List[int] = []
+
+    async def call(message_id: int) -> None:
+        token = CancelToken()
+        if args.scenario == "cancel":
+            asyncio.get_running_loop().call_later(args.cancel_after, token.cancel, "Cancelled by the benchmark.")
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(call_with_token, token, model, f"Request {message_id}: please write a quick sort.")
+        except GenerationCancelled:
+            cancelled.append(message_id)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for batch_start in range(0, args.channels * args.messages, args.channels):
+        await asyncio.gather(*[ call(message_id) for message_id in
+                                range(batch_start, min(batch_start + args.channels, args.channels * args.messages)) ])
+    return { "latencies": latencies, "wall": time.perf_counter() - start, "cancelled": len(cancelled) }
+
+
+def report(result: Dict, args: argparse.Namespace, server: FakeVllmServer) -> Dict:
+    from libs.startup import peak_rss_mb
+    latencies = result.pop("latencies")
+    summary = {
+        "scenario": args.scenario, "target": args.target, "backend": args.backend,
+        "requests": len(latencies), "server_requests": server.request_count,
+        # Streams the client closed early, i.e. cancelled or timed out generations
+        "server_disconnects": server.disconnects,
+        # Requests per script step, e.g. all of them on step 0 means the agent never got past its tool call
+        "server_steps": dict(sorted(server.steps.items())),
+        "wall_secs": round(result.pop("wall"), 3),
+        "p50_secs": round(percentile(latencies, 50), 3),
+        "p99_secs": round(percentile(latencies, 99), 3),
+        "max_secs": round(max(latencies, default=float("nan")), 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        **result,
+    }
+    summary["throughput_rps"] = round(len(latencies) / summary["wall_secs"], 3) if summary["wall_secs"] else 0.0
+    if args.tracemalloc:
+        summary["heap_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024**2, 1)
+    width = max(len(key) for key in summary)
+    print('\n' + '\n'.join(f"{key:<{width}} : {value}" for key, value in summary.items()))
+    return summary
+
+
+def compare(summary: Dict, baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path, 'r', encoding="utf-8") as file:
+        baseline = json.load(file)
+    regressions = []
+    if summary["p99_secs"] > baseline["p99_secs"] * (1 + tolerance):
+        regressions.append(f"p99 {baseline['p99_secs']} -> {summary['p99_secs']} secs")
+    if summary["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput_rps']} -> {summary['throughput_rps']} req/s")
+    for regression in regressions: print(f"REGRESSION: {regression}")
+    return not regressions
+
+
+async def amain(args: argparse.Namespace) -> int:
+    server = FakeVllmServer(model_name=args.model_name, latency=args.latency,
+                            tokens_per_sec=args.tps, script=build_script(args)).start()
+
+    # main.py reads its configuration from the environment at import time
+    os.environ.update({
+        "LOG_FMT": os.getenv("LOG_FMT", "[%(name)-9s] (%(levelname)-5s) %(message)s"),
+        "LOG_DATE_FMT": os.getenv("LOG_DATE_FMT", "%H:%M:%S"),
+        "HF_HOME": os.getenv("HF_HOME", os.path.expanduser("~/.cache/huggingface")),
+        "BACKEND": args.backend, "MODEL_NAME": args.model_name,
+        "MAX_MODEL_LEN": os.getenv("MAX_MODEL_LEN", "4096"),
+        "VLLM_PORT": str(server.port), "USER_ID": str(USER_ID), "DISCORD_TOKEN": "offline",
+        "HISTORY_DB": "",  # Keep benchmark conversations out of the real history
+    })
+    os.environ.update(dict(pair.split('=', 1) for pair in args.env))
+    import main
+    if args.scenario == "large_tool_output": write_tool_output(args.output_chars)
+
+    model = main.start_model(args.backend)
+    await model.wait_ready()
+
+    if args.tracemalloc: tracemalloc.start()
+    try:
+        if args.target == "bot": result = await run_bot(main, model, args)
+        else:                    result = await run_model(model, args)
+        # The server only notices a closed stream on its next write
+        if args.scenario == "cancel": await asyncio.sleep(0.5)
+    finally:
+        model.close()
+        server.stop()
+    summary = report(result, args, server)
+
+    if args.save:
+        with open(args.save, 'w', encoding="utf-8") as file:
+            json.dump(summary, file, indent=4)
+    if args.scenario == "cancel" and not summary["server_disconnects"]:
+        print("FAILED: the cancelled requests kept their streams to the server open")
+        return 1
+    if args.baseline and not compare(summary, args.baseline, args.tolerance):
+        return 1
+    return 0
+
+
+
+
+
+##### Execution #####
+if __name__ == "__main__":
+    sys.exit(asyncio.run(amain(parse_args())))
@@ -1,3 +1,45 @@
-from .hf import HfBaseModel, HfZephyr7bBeta, HfQwen, HfDeepseekCoderInstruct
-from .lc import VllmDockerLcModel
-from .qwen import VllmDockerQwenAgent
\ No newline at end of file
+##### Libraries #####
+import importlib
+from typing import Any, Dict, Tuple
+
+
+
+
+
+##### Parameters #####
+PROJECTS_ROOT: str = "projects"  # Workspace of the agent's project tools, uploads go here too
+# Backend name -> (module, class). Only the selected backend's module is imported,
+# so e.g. the vLLM Qwen agent never pays for torch / transformers / langchain.
+BACKENDS: Dict[str, Tuple[str, str]] = {
+    "hf_zephyr"  : ("libs.hf",   "HfZephyr7bBeta"),
+    "hf_qwen"    : ("libs.hf",   "HfQwen"),
+    "hf_deepseek": ("libs.hf",   "HfDeepseekCoderInstruct"),
+    "vllm_lc"    : ("libs.lc",   "VllmDockerLcModel"),
+    "vllm_qwen"  : ("libs.qwen", "VllmDockerQwenAgent"),
+}
+
+# Lazily resolved attributes, keeps `from libs import HfQwen` working
+_EXPORTS: Dict[str, str] = {
+    "HfBaseModel"        : "libs.hf",
+    "HfZephyr7bBeta"     : "libs.hf",
+    "HfQwen"             : "libs.hf",
+    "HfDeepseekCoderInstruct": "libs.hf",
+    "VllmDockerLcModel"  : "libs.lc",
+    "VllmDockerQwenAgent": "libs.qwen",
+}
+
+
+
+
+
+##### Functions #####
+def resolve_backend(name: str) -> type:
+    assert name in BACKENDS, f"Backend \"{name}\" invalid. Options: {list(BACKENDS)}."
+    module_name, class_name = BACKENDS[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def __getattr__(name: str) -> Any:
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,134 @@
+##### Libraries #####
+import bisect
+import asyncio
+import itertools
+import contextlib
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Optional
+from .cancel import CancelToken, GenerationCancelled
+
+
+
+
+
+##### Parameters #####
+# Lower runs first
+PRIORITY_COMMAND: int = 0  # Lifecycle commands, e.g. "!Start", "!Stop"; not held back by busy slots
+PRIORITY_CHAT   : int = 1  # Short prompts expected to finish in one completion
+PRIORITY_AGENT  : int = 2  # Long prompts and uploads, likely to run tool loops
+
+
+
+
+
+##### Classes #####
+class AdmissionRejected(Exception):
+    pass
+
+
+
+class Ticket(object):
+    def __init__(self, user_id: int, channel_id: int, priority: int, seq: int) -> None:
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.priority = priority
+        self.seq = seq
+        self.granted = asyncio.Event()
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+
+class AdmissionController(object):
+    """
+    Bounded priority queue in front of the model backend.
+
+    A ticket is granted when fewer than `max_active` requests are running and
+    its user and channel are under their own limits, so a busy channel does
+    not block the others. Waiting tickets are ordered by (priority, arrival).
+    Commands only count against the user limit, not against `max_active` or
+    the channel limit, so "!Stop" is not stuck behind the generation it is
+    meant to stop and a running "!Start" does not hold a generation slot.
+    """
+    def __init__(
+            self,
+            max_active: int = 1,
+            max_queue: int = 16,
+            max_per_user: int = 2,
+            max_per_channel: int = 1,
+        ) -> None:
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_per_channel = max_per_channel
+        self.waiting: List[Ticket] = []
+        self.active: List[Ticket] = []
+        self.active_requests = 0  # Active tickets other than commands, held against `max_active`
+        self.active_per_user: Dict[int, int] = defaultdict(int)
+        self.active_per_channel: Dict[int, int] = defaultdict(int)
+        self._seq = itertools.count()
+
+    def submit(self, user_id: int, channel_id: int, priority: int) -> Ticket:
+        if len(self.waiting) >= self.max_queue:
+            raise AdmissionRejected(f"Too busy: {len(self.active)} running and " + \
+                                    f"{len(self.waiting)} queued requests. Please try again later.")
+        ticket = Ticket(user_id, channel_id, priority, next(self._seq))
+        bisect.insort(self.waiting, ticket)
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """ 1-based position in the queue, 0 once the ticket is running. """
+        if ticket.granted.is_set(): return 0
+        return self.waiting.index(ticket) + 1
+
+    def release(self, ticket: Ticket) -> None:
+        if ticket in self.active:
+            self.active.remove(ticket)
+            self.active_per_user[ticket.user_id] -= 1
+            if ticket.priority != PRIORITY_COMMAND:
+                self.active_requests -= 1
+                self.active_per_channel[ticket.channel_id] -= 1
+        elif ticket in self.waiting:
+            self.waiting.remove(ticket)
+        self._dispatch()
+
+    async def acquire(self, ticket: Ticket, token: Optional[CancelToken] = None) -> None:
+        if token is None:
+            await ticket.granted.wait()
+            return
+        loop = asyncio.get_running_loop()
+        cancelled = loop.create_future()
+        unregister = token.on_cancel(lambda: loop.call_soon_threadsafe(
+            lambda: cancelled.done() or cancelled.set_result(None)))
+        granted = asyncio.ensure_future(ticket.granted.wait())
+        try:
+            await asyncio.wait([ granted, cancelled ], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            unregister()
+            granted.cancel()
+        if not ticket.granted.is_set():
+            raise GenerationCancelled(token.reason)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, ticket: Ticket, token: Optional[CancelToken] = None) -> AsyncIterator[None]:
+        try:
+            await self.acquire(ticket, token)
+            yield
+        finally:
+            self.release(ticket)
+
+    def _dispatch(self) -> None:
+        for ticket in list(self.waiting):
+            if ticket.priority != PRIORITY_COMMAND:
+                if self.active_requests >= self.max_active: return
+                if self.active_per_channel[ticket.channel_id] >= self.max_per_channel: continue
+            if self.active_per_user[ticket.user_id] >= self.max_per_user: continue
+            self.waiting.remove(ticket)
+            self.active.append(ticket)
+            self.active_per_user[ticket.user_id] += 1
+            if ticket.priority != PRIORITY_COMMAND:
+                self.active_requests += 1
+                self.active_per_channel[ticket.channel_id] += 1
+            ticket.granted.set()
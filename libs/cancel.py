@@ -0,0 +1,192 @@
+##### Libraries #####
+import os
+import time
+import signal
+import threading
+import subprocess
+import contextvars
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+T = TypeVar("T")
+
+
+
+
+
+##### Context #####
+# The token of the request currently being served by this thread / task.
+# ``asyncio.to_thread`` copies the context, so the token follows the request
+# into the backend without changing every model's call signature.
+CURRENT_TOKEN: contextvars.ContextVar[Optional["CancelToken"]] = \
+    contextvars.ContextVar("CURRENT_TOKEN", default=None)
+
+
+
+
+
+##### Classes #####
+class GenerationCancelled(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+
+class CancelToken(object):
+    def __init__(
+            self,
+            timeout: Optional[float] = None,
+            channel_id: Optional[int] = None,
+        ) -> None:
+        self.set_timeout(timeout)
+        self.channel_id = channel_id
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], Any]] = []
+
+    def set_timeout(self, timeout: Optional[float]) -> None:
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def cancel(self, reason: str = "Cancelled by user.") -> None:
+        with self._lock:
+            if self._event.is_set(): return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks: callback()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and \
+           self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("Deadline exceeded.")
+        return self._event.is_set()
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None: return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ Sleep up to `timeout` secs, waking early on cancellation. Returns `cancelled`. """
+        remaining = self.remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        self._event.wait(timeout)
+        return self.cancelled
+
+    def on_cancel(self, callback: Callable[[], Any]) -> Callable[[], None]:
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                def unregister() -> None:
+                    with self._lock:
+                        if callback in self._callbacks: self._callbacks.remove(callback)
+                return unregister
+        callback()
+        return lambda: None
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled: raise GenerationCancelled(self.reason)
+
+
+
+
+
+##### Functions #####
+def current_token() -> Optional[CancelToken]:
+    return CURRENT_TOKEN.get()
+
+
+def call_with_token(token: CancelToken, func: Callable[..., T], *args, **kwargs) -> T:
+    """ Run `func` with `token` as the current token, e.g. inside `asyncio.to_thread`. """
+    reset = CURRENT_TOKEN.set(token)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        CURRENT_TOKEN.reset(reset)
+    token.raise_if_cancelled()
+    return result
+
+
+def iterate_cancellable(iterable: Iterable[T]) -> Iterator[T]:
+    """
+    Yield from `iterable` until the current token is cancelled, then close it.
+    An error raised after the cancellation, e.g. by a stream closed through
+    `close_on_cancel`, is reported as the cancellation.
+    """
+    token = current_token()
+    iterator = iter(iterable)
+    try:
+        for item in iterator:
+            if token is not None: token.raise_if_cancelled()
+            yield item
+    except Exception:
+        if token is not None: token.raise_if_cancelled()
+        raise
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None: close()
+    if token is not None: token.raise_if_cancelled()
+
+
+def close_on_cancel(stream: T) -> T:
+    """
+    Close `stream` as soon as the current token is cancelled, also while a read
+    is blocked on it. Closing a streamed completion drops its HTTP connection,
+    which makes the vLLM server abort the request and free its KV cache.
+    """
+    token = current_token()
+    if token is not None and hasattr(stream, "close"): token.on_cancel(stream.close)
+    return stream
+
+
+def kill_process_tree(process: subprocess.Popen) -> None:
+    if process.poll() is not None: return
+    if os.name == "nt":
+        # "cmd.exe /c activate && python ..." leaves python as a grandchild
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+
+
+def popen_kwargs() -> dict:
+    """ Start children in their own process group so `kill_process_tree` can reap them. """
+    if os.name == "nt":
+        return { "creationflags": subprocess.CREATE_NEW_PROCESS_GROUP }
+    return { "start_new_session": True }
+
+
+def run_cancellable(
+        command: List[str],
+        cwd: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Tuple[int, str, str]:
+    """
+    `subprocess.run` replacement that kills the child (and its children) when
+    the current token is cancelled or `timeout` elapses.
+    Returns (returncode, stdout, stderr).
+    """
+    token = current_token()
+    if token is not None and token.remaining() is not None:
+        timeout = token.remaining() if timeout is None else min(timeout, token.remaining())
+    process = subprocess.Popen(command, text=True, cwd=cwd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               **popen_kwargs())
+    unregister = token.on_cancel(lambda: kill_process_tree(process)) \
+        if token is not None else (lambda: None)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_tree(process)
+        stdout, stderr = process.communicate()
+        if token is not None: token.raise_if_cancelled()
+        stderr += f"\nTimeoutExpired: execution exceeded {timeout} secs and was killed."
+    finally:
+        unregister()
+    if token is not None: token.raise_if_cancelled()
+    return process.returncode, stdout, stderr
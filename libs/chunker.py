@@ -0,0 +1,96 @@
+##### Libraries #####
+import re
+from typing import Iterable, Iterator, List, Optional, Union
+
+
+
+
+
+##### Parameters #####
+MESSAGE_LIMIT: int = 1900
+FENCE: str = "```"
+FENCE_LANGUAGE = re.compile(r"[\w+#.-]*")
+
+
+
+
+
+##### Classes #####
+class Chunker(object):
+    """
+    Single-pass splitter of text into chunks of at most `limit` chars.
+
+    Chunks are cut at line boundaries. A code block cut in two is closed at
+    the end of the chunk and reopened with its language in the next one, and
+    lines longer than a chunk are hard-wrapped. Text can be fed piece by
+    piece as it is generated; every finished chunk is yielded right away.
+    """
+    def __init__(self, limit: int = MESSAGE_LIMIT) -> None:
+        self.limit = limit
+        self.lines: List[str] = []
+        self.size = 0                      # Length of '\n'.join(self.lines)
+        self.fence: Optional[str] = None   # Language of the open code block, '' if none given
+        self.partial: List[str] = []       # Fed text after the last newline
+
+    def feed(self, text: str) -> Iterator[str]:
+        *lines, rest = text.split('\n')
+        if lines:
+            lines[0] = ''.join(self.partial) + lines[0]
+            self.partial = []
+            for line in lines: yield from self.add_line(line)
+        if rest: self.partial.append(rest)
+
+    def close(self) -> Iterator[str]:
+        if self.partial:
+            yield from self.add_line(''.join(self.partial))
+            self.partial = []
+        if self.lines and (self.size or len(self.lines) > 1):
+            yield '\n'.join(self.lines)
+        self.lines, self.size = [], 0
+
+    def add_line(self, line: str) -> Iterator[str]:
+        # Room kept for reopening ("```lang\n") and closing ("\n```") the block
+        overhead = len(FENCE) + len(self.fence or '') + 1 + len(FENCE) + 1 if self.fence is not None else 0
+        width = max(1, self.limit - overhead)
+        for start in range(0, max(len(line), 1), width):
+            piece = line[start:start+width]
+            closing = len(FENCE) + 1 if self.fence is not None else 0
+            if self.lines and self.size + 1 + len(piece) + closing > self.limit:
+                yield self.flush()
+            self.size += len(piece) + (1 if self.lines else 0)
+            self.lines.append(piece)
+        self.update_fence(line)
+
+    def update_fence(self, line: str) -> None:
+        if line.count(FENCE) % 2 == 0: return
+        if self.fence is None:
+            self.fence = FENCE_LANGUAGE.match(line.rsplit(FENCE, 1)[1].strip()).group()
+        else:
+            self.fence = None
+
+    def flush(self) -> str:
+        if self.fence is None:
+            chunk = '\n'.join(self.lines)
+            self.lines, self.size = [], 0
+        else:
+            chunk = '\n'.join(self.lines) + '\n' + FENCE
+            self.lines = [ FENCE + self.fence ]
+            self.size = len(self.lines[0])
+        return chunk
+
+
+
+
+
+##### Functions #####
+def iter_chunks(text: Union[str, Iterable[str]], limit: int = MESSAGE_LIMIT) -> Iterator[str]:
+    """ Yield Discord-sized chunks of `text`, which may also be an iterable of streamed pieces. """
+    chunker = Chunker(limit)
+    for piece in ([ text ] if isinstance(text, str) else text):
+        yield from chunker.feed(piece)
+    yield from chunker.close()
+
+
+def split_message(message: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    if len(message) <= limit: return [ message ]
+    return list(iter_chunks(message, limit))
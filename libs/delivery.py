@@ -0,0 +1,141 @@
+##### Libraries #####
+import io
+import re
+import time
+import asyncio
+import discord
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from .chunker import MESSAGE_LIMIT, split_message
+from .logs import get_logger
+
+
+
+
+
+##### Parameters #####
+LOG_LEVEL: int = logging.INFO
+# Discord allows 5 messages per 5 secs in one channel and 50 requests per sec in total
+CHANNEL_CAPACITY : int = 5
+CHANNEL_WINDOW   : float = 5.0
+GLOBAL_CAPACITY  : int = 50
+GLOBAL_WINDOW    : float = 1.0
+# A section needing more messages than this is uploaded as a file instead
+ATTACH_AFTER     : int = 4
+ATTACHMENT_LIMIT : int = 8 * 1024**2  # Upload limit of non-boosted servers
+
+
+
+
+
+##### Loggers #####
+LOGGER = get_logger("Delivery", LOG_LEVEL)
+
+
+
+
+
+##### Functions #####
+def make_attachment(role: Optional[str], content: str) -> Tuple[str, bytes]:
+    stem = re.sub(r"[^A-Za-z0-9]+", '_', role or "response").strip('_').lower() or "response"
+    # A single code block is uploaded as a source file so Discord highlights the preview
+    match = re.fullmatch(r"\s*```(\w+)\n((?:(?!```).)*)```\s*", content, flags=re.DOTALL)
+    extension = { "py": "py", "python": "py", "js": "js", "javascript": "js",
+                  "json": "json", "sh": "sh", "bash": "sh" }.get(match.group(1).lower()) if match else None
+    if extension is None: return f"{stem}.md", content.encode("utf-8")
+    return f"{stem}.{extension}", match.group(2).encode("utf-8")
+
+
+
+
+
+##### Classes #####
+class RateLimitBucket(object):
+    """ Sliding window limiter for one Discord route, pushed back further by 429 responses. """
+    def __init__(self, capacity: int, window: float) -> None:
+        self.capacity = capacity
+        self.window = window
+        self.sent: Deque[float] = deque()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.sent and self.sent[0] <= now - self.window: self.sent.popleft()
+                wait = max(self.blocked_until - now,
+                           self.sent[0] + self.window - now if len(self.sent) >= self.capacity else 0.0)
+                if wait <= 0: break
+                await asyncio.sleep(wait)
+            self.sent.append(time.monotonic())
+
+    def block(self, retry_after: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+
+
+class DeliveryEngine(object):
+    """
+    Sends (role, content) sections to Discord without blocking the event loop.
+
+    Consecutive small sections are packed into as few messages as fit, a
+    section that would take more than `ATTACH_AFTER` messages is uploaded as
+    a file, and each channel has its own rate limit bucket, so deliveries to
+    different channels run in parallel while one channel stays in order.
+    """
+    def __init__(self, limit: int = MESSAGE_LIMIT) -> None:
+        self.limit = limit
+        self.global_bucket = RateLimitBucket(GLOBAL_CAPACITY, GLOBAL_WINDOW)
+        self.channel_buckets: Dict[int, RateLimitBucket] = {}
+        self.channel_locks: Dict[int, asyncio.Lock] = {}
+
+    def plan(self, sections: List[Tuple[Optional[str], str]]) -> List[Tuple[str, Optional[Tuple[str, bytes]]]]:
+        """ Turn sections into a list of (message content, optional (filename, data)) to send. """
+        pieces: List[Tuple[str, Optional[Tuple[str, bytes]]]] = []
+        for role, content in sections:
+            header = f"# {role}:\n" if role else ''
+            chunks = split_message(header + content, self.limit)
+            filename, data = make_attachment(role, content)
+            if len(chunks) > ATTACH_AFTER and len(data) <= ATTACHMENT_LIMIT:
+                note = f"{header}*Full output ({len(content)} chars) attached as `{filename}`.*"
+                pieces.append((note, (filename, data)))
+            else:
+                pieces.extend((chunk, None) for chunk in chunks)
+
+        # Coalesce consecutive pieces, e.g. "Function Call" + its result
+        messages: List[Tuple[str, Optional[Tuple[str, bytes]]]] = []
+        for content, attachment in pieces:
+            if not content.strip() and attachment is None: continue
+            if messages and messages[-1][1] is None and \
+               len(messages[-1][0]) + 1 + len(content) <= self.limit:
+                messages[-1] = (messages[-1][0].rstrip('\n') + '\n' + content, attachment)
+            else:
+                messages.append((content, attachment))
+        return messages
+
+    async def send(self, channel, content: str, attachment: Optional[Tuple[str, bytes]]) -> None:
+        bucket = self.channel_buckets.setdefault(channel.id, RateLimitBucket(CHANNEL_CAPACITY, CHANNEL_WINDOW))
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            kwargs = { "file": discord.File(io.BytesIO(attachment[1]), filename=attachment[0]) } \
+                if attachment else {}
+            try:
+                await channel.send(content, **kwargs)
+                return
+            except discord.HTTPException as ex:
+                if ex.status != 429: raise
+                retry_after = float(ex.response.headers.get("Retry-After", 1.0))
+                LOGGER.warning(f"Rate limited in channel {channel.id}, retrying after {retry_after} secs.")
+                bucket.block(retry_after)
+
+    async def deliver(self, channel, sections: List[Tuple[Optional[str], str]]) -> int:
+        messages = self.plan(sections)
+        lock = self.channel_locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            for content, attachment in messages:
+                await self.send(channel, content, attachment)
+        LOGGER.debug(f"Delivered {len(sections)} section(s) in {len(messages)} message(s).")
+        return len(messages)
@@ -1,31 +1,72 @@
 ##### Libraries #####
 import torch
 import logging
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from typing import Callable, List, Optional
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+from .cancel import CancelToken, current_token
+from .logs import get_logger
 
 
 
 
 
 ##### Loggers #####
-HF_LOGGER = logging.getLogger("Hugging Face")
-HF_LOGGER.setLevel(logging.DEBUG)
-HF_HANDLER = logging.StreamHandler()
-HF_HANDLER.setLevel(logging.DEBUG)
-HF_HANDLER.setFormatter(logging.Formatter(
-    "\n[%(levelname)s] (%(name)s) %(asctime)s | %(filename)s: %(funcName)s: %(lineno)03d | %(message)s",
-    datefmt="%m-%d %H:%M:%S"
-))
-HF_LOGGER.addHandler(HF_HANDLER)
+HF_LOGGER = get_logger("Hugging Face", logging.DEBUG)
 
 
 
 
 
 ##### Classes #####
+class CancelStoppingCriteria(StoppingCriteria):
+    def __init__(self, token: CancelToken) -> None:
+        self.token = token
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.token.cancelled,
+                          dtype=torch.bool, device=input_ids.device)
+
+
+
 class HfBaseModel(object):
-    def __init__(self) -> None:
-        pass
+    def __init__(self, progress: Optional[Callable[[str], None]] = None) -> None:
+        self.progress = progress or HF_LOGGER.info
+
+    def load_pretrained(self, model_name: str, tokenizer_kwargs: Optional[dict] = None, **model_kwargs) -> None:
+        self.progress(f"Loading tokenizer of \"{model_name}\"...")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, **(tokenizer_kwargs or {}))
+        self.progress(f"Loading weights of \"{model_name}\"...")
+        # Safetensors checkpoints are preferred and memory-mapped, and
+        # low_cpu_mem_usage streams them to the device without a full CPU copy
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name, low_cpu_mem_usage=True, **model_kwargs)
+        HF_LOGGER.info(f"Model \"{model_name}\" successfully loaded!")
+
+    def batch(self, current_msgs: List[str]) -> List[str]:
+        """ Answer several independent messages, models that can pad and batch override this. """
+        return [ self(current_msg) for current_msg in current_msgs ]
+
+    def warmup(self) -> None:
+        """ Run a tiny generation so kernels are compiled and CUDA caches allocated before the first request. """
+        self.progress("Warming up...")
+        inputs = self.tokenizer("Hello", return_tensors="pt").to(self.device)
+        with torch.inference_mode():
+            self.model.generate(inputs.input_ids, max_new_tokens=8)
+
+    def stopping_criteria(self) -> StoppingCriteriaList:
+        """ Stops `generate` at the next token once the current request is cancelled. """
+        token = current_token()
+        return StoppingCriteriaList([ CancelStoppingCriteria(token) ] if token is not None else [])
+
+    def raise_if_cancelled(self) -> None:
+        token = current_token()
+        if token is not None: token.raise_if_cancelled()
 
 
 
@@ -35,20 +76,20 @@ class HfZephyr7bBeta(HfBaseModel):
             device: str = "cuda:0" if torch.cuda.is_available() else "cpu",
             load_in_8bit: bool = True,
             load_in_4bit: bool = False,
+            progress: Optional[Callable[[str], None]] = None,
         ) -> None:
+        super().__init__(progress)
 
         assert not (load_in_8bit and load_in_4bit), \
             "Parameters 'load_in_8bit' and 'load_in_4bit' cannot both be True."
         
         model_name = "HuggingFaceH4/zephyr-7b-beta"
         self.device = device
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(
+        self.load_pretrained(
             model_name, device_map=device,
             quantization_config=BitsAndBytesConfig(load_in_8bit=load_in_8bit,
                                                    load_in_4bit=load_in_4bit),
         )
-        HF_LOGGER.info(f"Model \"{model_name}\" successfully loaded!")
         self.eos_token_id = \
             self.tokenizer.encode("User:", add_special_tokens=False)[-1]
     
@@ -58,21 +99,23 @@ class HfZephyr7bBeta(HfBaseModel):
     
 
     def inference(self, msg_tpl: str) -> str:
-        HF_LOGGER.debug("msg_tpl:\n\n", msg_tpl)
+        HF_LOGGER.debug("msg_tpl:", extra={ "payload": msg_tpl })
         msg_tpl_pt: torch.Tensor = \
             self.tokenizer(msg_tpl, return_tensors="pt").input_ids.to(self.device)
         generate_ids = self.model.generate(
             msg_tpl_pt,
             max_new_tokens=512,
             eos_token_id=self.eos_token_id,
-            repetition_penalty=1.2
+            repetition_penalty=1.2,
+            stopping_criteria=self.stopping_criteria(),
         )
+        self.raise_if_cancelled()
         response = self.tokenizer.batch_decode(
             generate_ids,
             skip_special_tokens=True,
             clean_up_tokenization_spaces=False
         )[0]
-        HF_LOGGER.debug("Generated response:\n", response)
+        HF_LOGGER.debug("Generated response:", extra={ "payload": response })
         return response
     
 
@@ -92,8 +135,9 @@ class HfQwen(HfBaseModel):
             device: str = "cuda:0" if torch.cuda.is_available() else "cpu",
             load_in_8bit: bool = False,
             load_in_4bit: bool = True,
+            progress: Optional[Callable[[str], None]] = None,
         ) -> None:
-        super().__init__()
+        super().__init__(progress)
 
         assert param_num in [ 0.5, 1.8, 4, 7, 14 ], \
             "Parameter 'param_num' invalid."
@@ -105,10 +149,7 @@ class HfQwen(HfBaseModel):
         elif load_in_4bit: model_name += "-GPTQ-Int4"
 
         self.device = device
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name, torch_dtype="auto", device_map=device)
-        HF_LOGGER.info(f"Model \"{model_name}\" successfully loaded!")
+        self.load_pretrained(model_name, torch_dtype="auto", device_map=device)
 
 
     def inference(self, messages: str) -> str:
@@ -116,7 +157,9 @@ class HfQwen(HfBaseModel):
             messages, tokenize=False, add_generation_prompt=True)
         inputs = self.tokenizer([msg_tpl], return_tensors="pt").to(self.device)
         generated_ids = self.model.generate(
-            inputs.input_ids, max_new_tokens=512)
+            inputs.input_ids, max_new_tokens=512,
+            stopping_criteria=self.stopping_criteria())
+        self.raise_if_cancelled()
         generated_ids = [
             output_ids[len(input_ids):]
             for input_ids, output_ids in zip(inputs.input_ids, generated_ids)
@@ -156,8 +199,9 @@ class HfDeepseekCoderInstruct(HfBaseModel):
             device: str = "cuda:0" if torch.cuda.is_available() else "cpu",
             load_in_8bit: bool = False,
             load_in_4bit: bool = False,
+            progress: Optional[Callable[[str], None]] = None,
         ) -> None:
-        super().__init__()
+        super().__init__(progress)
 
         assert param_num in [ 6.7, 33 ], \
             "Parameter 'param_num' invalid."
@@ -170,15 +214,14 @@ class HfDeepseekCoderInstruct(HfBaseModel):
             HF_LOGGER.info(f"Loading {model_name}, using 4bit quantization.")
 
         self.device = device
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
+        self.load_pretrained(
             model_name,
+            tokenizer_kwargs={ "trust_remote_code": True },
             device_map=device,
             quantization_config=BitsAndBytesConfig(load_in_8bit=load_in_8bit,
                                                    load_in_4bit=load_in_4bit),
             trust_remote_code=True,
         )
-        HF_LOGGER.info(f"Model \"{model_name}\" successfully loaded!")
 
 
     def inference(self, messages: str) -> str:
@@ -187,11 +230,35 @@ class HfDeepseekCoderInstruct(HfBaseModel):
         outputs = self.model.generate(inputs, max_new_tokens=512, do_sample=False,
                                       # temperature=0.1, top_p=0.95,
                                       top_k=50, num_return_sequences=1,
-                                      eos_token_id=self.tokenizer.eos_token_id)
+                                      eos_token_id=self.tokenizer.eos_token_id,
+                                      stopping_criteria=self.stopping_criteria())
+        self.raise_if_cancelled()
         return self.tokenizer.decode(outputs[0][len(inputs[0]):],
                                      skip_special_tokens=True)
 
 
     def __call__(self, current_msg: str) -> str:
         messages = [{ "role": "user", "content": current_msg }]
-        return self.inference(messages)
\ No newline at end of file
+        return self.inference(messages)
+
+
+    def batch(self, current_msgs: List[str]) -> List[str]:
+        # Left padding keeps every prompt adjacent to its generated tokens
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        msg_tpls = [
+            self.tokenizer.apply_chat_template([{ "role": "user", "content": current_msg }],
+                                               tokenize=False, add_generation_prompt=True)
+            for current_msg in current_msgs
+        ]
+        inputs = self.tokenizer(msg_tpls, return_tensors="pt", padding=True,
+                                add_special_tokens=False).to(self.device)
+        outputs = self.model.generate(**inputs, max_new_tokens=512, do_sample=False,
+                                      top_k=50, num_return_sequences=1,
+                                      eos_token_id=self.tokenizer.eos_token_id,
+                                      pad_token_id=self.tokenizer.pad_token_id,
+                                      stopping_criteria=self.stopping_criteria())
+        self.raise_if_cancelled()
+        return self.tokenizer.batch_decode(outputs[:, inputs.input_ids.shape[1]:],
+                                           skip_special_tokens=True)
\ No newline at end of file
@@ -0,0 +1,221 @@
+##### Libraries #####
+import os
+import re
+import asyncio
+import logging
+import tarfile
+import zipfile
+import aiohttp
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+from . import PROJECTS_ROOT
+from .logs import get_logger
+
+
+
+
+
+##### Parameters #####
+LOG_LEVEL: int = logging.INFO
+CHUNK_SIZE      : int = 64 * 1024
+MAX_FILE_BYTES  : int = int(os.getenv("MAX_UPLOAD_FILE_MB", 25)) * 1024**2
+MAX_TOTAL_BYTES : int = int(os.getenv("MAX_UPLOAD_TOTAL_MB", 200)) * 1024**2
+MAX_FILES       : int = int(os.getenv("MAX_UPLOAD_FILES", 2000))
+MANIFEST_ENTRIES: int = 40                # Files listed to the agent, the rest are only counted
+ARCHIVE_SUFFIXES: Tuple[str, ...] = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+# Never written from an upload; "venv4W" is the environment `MyCodeExecutor` activates and runs
+SKIPPED_DIRS    : Tuple[str, ...] = ("__MACOSX", ".git", "__pycache__", "node_modules", "venv", ".venv", "venv4W")
+
+
+
+
+
+##### Loggers #####
+LOGGER = get_logger("Ingest", LOG_LEVEL)
+
+
+
+
+
+##### Functions #####
+def safe_join(root: str, *parts: str) -> str:
+    """ Join `parts` under `root`, refusing absolute paths and anything resolving outside of it. """
+    relative = os.path.join(*[ part.replace('\\', '/') for part in parts ])
+    if os.path.isabs(relative) or re.match(r"^[A-Za-z]:", relative):
+        raise ValueError(f"absolute path \"{relative}\" is not allowed")
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, relative))
+    if os.path.commonpath([ root, path ]) != root:
+        raise ValueError(f"path \"{relative}\" escapes the project")
+    return path
+
+
+def project_name(filename: str) -> str:
+    stem = os.path.basename(filename.replace('\\', '/'))
+    for suffix in sorted(ARCHIVE_SUFFIXES, key=len, reverse=True):
+        if stem.lower().endswith(suffix):
+            stem = stem[:-len(suffix)]
+            break
+    else:
+        stem = os.path.splitext(stem)[0]
+    return re.sub(r"[^A-Za-z0-9_.-]+", '_', stem).strip("._") or "upload"
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def copy_capped(source: BinaryIO, path: str, limit: int) -> int:
+    """ Copy in chunks and stop past `limit` bytes, whatever size the archive claimed. """
+    written = 0
+    with open(path, "wb") as file:
+        while chunk := source.read(CHUNK_SIZE):
+            written += len(chunk)
+            if written > limit: break
+            file.write(chunk)
+    if written > limit:
+        os.remove(path)
+        raise ValueError(f"larger than {limit // 1024**2} MB")
+    return written
+
+
+def iter_members(archive_path: str) -> Iterator[Tuple[str, int, Optional[BinaryIO]]]:
+    """ Yield (name, declared size, reader or None for non-regular entries) one member at a time. """
+    if archive_path.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir(): continue
+                # Unix symlinks are stored as regular entries flagged in the high mode bits
+                if (info.external_attr >> 16) & 0o170000 == 0o120000:
+                    yield info.filename, info.file_size, None
+                    continue
+                with archive.open(info) as reader:
+                    yield info.filename, info.file_size, reader
+    else:
+        # Streaming mode ("r|*") reads the tarball front to back without seeking
+        with open(archive_path, "rb") as raw, tarfile.open(fileobj=raw, mode="r|*") as archive:
+            for member in archive:
+                if member.isdir(): continue
+                yield member.name, member.size, archive.extractfile(member) if member.isfile() else None
+
+
+
+
+
+##### Classes #####
+class Manifest(object):
+    """ What an upload produced, rendered as a short listing for the agent instead of the contents. """
+    def __init__(self, project: str) -> None:
+        self.project = project
+        self.files: List[Tuple[str, int]] = []
+        self.skipped: List[Tuple[str, str]] = []
+        self.total_bytes = 0
+
+    def add(self, path: str, size: int) -> None:
+        self.files.append((path, size))
+        self.total_bytes += size
+
+    def skip(self, path: str, reason: str) -> None:
+        LOGGER.warning(f"Skipped \"{path}\" ({reason}).")
+        self.skipped.append((path, reason))
+
+    def summary(self) -> str:
+        text = f"Saved {len(self.files)} file(s), {self.total_bytes / 1024:.0f} KB, to project \"{self.project}\"."
+        if self.skipped: text += f" Skipped {len(self.skipped)}: " + \
+            ', '.join(f"{path} ({reason})" for path, reason in self.skipped[:5]) + \
+            (", ..." if len(self.skipped) > 5 else '')
+        return text
+
+    def render(self) -> str:
+        lines = [ f"[Uploaded files] Project name: \"{self.project}\", " + \
+                  f"{len(self.files)} file(s), {self.total_bytes / 1024:.0f} KB. " + \
+                  "Use project_manager to read only the files you need:" ]
+        for path, size in sorted(self.files)[:MANIFEST_ENTRIES]:
+            lines.append(f"- {path} ({size} B)")
+        if len(self.files) > MANIFEST_ENTRIES:
+            lines.append(f"- ... and {len(self.files) - MANIFEST_ENTRIES} more, use \"walk\" to list them")
+        return '\n'.join(lines)
+
+
+
+class AttachmentIngester(object):
+    """
+    Streams Discord attachments into `PROJECTS_ROOT/<project>` and unpacks archives.
+
+    Downloads go to disk chunk by chunk, so memory does not grow with the
+    upload, and archives are extracted member by member in a thread. Every
+    path goes through `safe_join`, and the per-file, total and file count
+    caps are checked against the bytes actually written.
+    """
+    def __init__(self, root: str = PROJECTS_ROOT) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    async def ingest(self, attachments: List, project: Optional[str] = None) -> Manifest:
+        project = project or project_name(attachments[0].filename)
+        project_dir = safe_join(self.root, project)
+        os.makedirs(project_dir, exist_ok=True)
+        manifest = Manifest(project)
+        async with aiohttp.ClientSession() as session:
+            for attachment in attachments:
+                try:
+                    await self.ingest_one(session, attachment, project_dir, manifest)
+                except (ValueError, OSError, aiohttp.ClientError, zipfile.BadZipFile, tarfile.TarError) as ex:
+                    manifest.skip(attachment.filename, str(ex))
+        LOGGER.info(manifest.summary())
+        return manifest
+
+    async def ingest_one(self, session: aiohttp.ClientSession, attachment, project_dir: str, manifest: Manifest) -> None:
+        name = os.path.basename(attachment.filename.replace('\\', '/'))
+        archive = is_archive(name)
+        # An archive may be bigger than one file, its contents are capped one by one
+        limit = MAX_TOTAL_BYTES - manifest.total_bytes if archive else \
+            min(MAX_FILE_BYTES, MAX_TOTAL_BYTES - manifest.total_bytes)
+        if attachment.size > limit:
+            raise ValueError(f"{attachment.size // 1024**2} MB is over the upload limit")
+        # A hidden name keeping the suffix, which tells the archive format
+        path = safe_join(project_dir, f".upload-{name}" if archive else name)
+        size = await self.download(session, attachment.url, path, limit)
+        if not archive:
+            manifest.add(os.path.relpath(path, project_dir).replace(os.sep, '/'), size)
+            return
+        try:
+            await asyncio.to_thread(self.extract, path, project_dir, manifest)
+        finally:
+            os.remove(path)
+
+    async def download(self, session: aiohttp.ClientSession, url: str, path: str, limit: int) -> int:
+        written = 0
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                with open(path, "wb") as file:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        written += len(chunk)
+                        if written > limit: raise ValueError("over the upload limit")
+                        file.write(chunk)
+        except BaseException:
+            if os.path.exists(path): os.remove(path)
+            raise
+        return written
+
+    def extract(self, archive_path: str, project_dir: str, manifest: Manifest) -> None:
+        for name, declared_size, reader in iter_members(archive_path):
+            parts = name.replace('\\', '/').split('/')
+            if any(part in SKIPPED_DIRS for part in parts): continue
+            if reader is None:
+                manifest.skip(name, "not a regular file")
+                continue
+            if len(manifest.files) >= MAX_FILES:
+                manifest.skip(name, f"over {MAX_FILES} files")
+                break
+            limit = min(MAX_FILE_BYTES, MAX_TOTAL_BYTES - manifest.total_bytes)
+            if declared_size > limit:
+                manifest.skip(name, "over the upload limit")
+                continue
+            try:
+                path = safe_join(project_dir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                manifest.add(os.path.relpath(path, project_dir).replace(os.sep, '/'),
+                             copy_capped(reader, path, limit))
+            except ValueError as ex:
+                manifest.skip(name, str(ex))
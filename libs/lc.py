@@ -1,21 +1,17 @@
 ##### Libraries #####
-import os
 import logging
 from typing import List
 from transformers import AutoTokenizer
 from langchain_community.llms.vllm import VLLMOpenAI
+from .cancel import close_on_cancel, current_token, iterate_cancellable
+from .logs import get_logger
 
 
 
 
 
 ##### Loggers #####
-LC_LOGGER = logging.getLogger("LangChain")
-LC_LOGGER.setLevel(logging.DEBUG)
-LC_HANDLER = logging.StreamHandler()
-LC_HANDLER.setLevel(logging.DEBUG)
-LC_HANDLER.setFormatter(logging.Formatter('\n'+os.environ["LOG_FMT"], datefmt=os.environ["LOG_DATE_FMT"]))
-LC_LOGGER.addHandler(LC_HANDLER)
+LC_LOGGER = get_logger("LangChain", logging.DEBUG)
 
 
 
@@ -85,10 +81,18 @@ class VllmDockerLcModel(VllmDockerLcBaseModel):
             allowed_special=set(),     # AbstractSet[str] | Literal['all']
             disallowed_special="all",  #  Collection[str] | Literal['all']
         )
+        # Closing the LangChain stream leaves the HTTP stream open, so the
+        # completion itself is closed when the request is cancelled
+        create = self.model.client.create
+        self.model.client.create = lambda *args, **kwargs: close_on_cancel(create(*args, **kwargs))
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
     
     def generate_response(self, message: str) -> str:
-        response = self.model.invoke(message)
+        if current_token() is None:
+            response = self.model.invoke(message)
+        else:
+            # Stream so that a cancellation can close the request mid-generation
+            response = ''.join(iterate_cancellable(self.model.stream(message)))
         res_token_len = len(self.tokenizer.encode(response))
         LC_LOGGER.debug(
             f"The token length of the response text is {res_token_len}.")
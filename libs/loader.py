@@ -0,0 +1,127 @@
+##### Libraries #####
+import time
+import asyncio
+import contextlib
+import logging
+import threading
+from typing import Any, Callable, Optional
+from .cancel import CancelToken, current_token
+from .startup import StartupProfile
+from .logs import get_logger
+
+
+
+
+
+##### Parameters #####
+LOG_LEVEL: int = logging.INFO
+PENDING: str = "pending"
+LOADING: str = "loading"
+READY  : str = "ready"
+FAILED : str = "failed"
+
+
+
+
+
+##### Loggers #####
+LOGGER = get_logger("Loader", LOG_LEVEL)
+
+
+
+
+
+##### Classes #####
+class ModelLoadFailed(Exception):
+    pass
+
+
+
+class BackgroundModel(object):
+    """
+    Builds the model with `factory(progress)` in a background thread, so the
+    bot can go online while the weights are still loading.
+
+    Callable like the model itself: calls made before it is ready block
+    until it is (or until the current request is cancelled). With a
+    `profile`, the warm-up is timed and a "Model ready" report is logged.
+    """
+    def __init__(
+            self,
+            factory: Callable[[Callable[[str], None]], Any],
+            warmup: bool = False,
+            profile: Optional[StartupProfile] = None,
+        ) -> None:
+        self.factory = factory
+        self.warmup = warmup
+        self.profile = profile
+        self.model: Any = None
+        self.state = PENDING
+        self.stage = "Waiting to start"
+        self.error: Optional[Exception] = None
+        self.loaded = threading.Event()
+        self.closed = False
+        self.start_time: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time if self.start_time else 0.0
+
+    def status(self) -> str:
+        return f"{self.stage} ({self.elapsed:.0f} secs elapsed)"
+
+    def progress(self, stage: str) -> None:
+        self.stage = stage
+        LOGGER.info(f"[{self.elapsed:6.1f} s] {stage}")
+
+    def start(self) -> None:
+        if self.state != PENDING: return
+        self.state = LOADING
+        self.start_time = time.perf_counter()
+        threading.Thread(target=self.load, daemon=True).start()
+
+    def load(self) -> None:
+        try:
+            model = self.factory(self.progress)
+            if self.warmup and hasattr(model, "warmup"):
+                self.progress("Running warm-up generation...")
+                with self.profile.stage("warm-up") if self.profile else contextlib.nullcontext():
+                    model.warmup()
+            self.model = model
+            if self.closed:
+                self.close()
+                return
+            self.state = READY
+            self.progress("Model is ready.")
+            if self.profile: self.profile.report("Model ready")
+        except Exception as ex:
+            self.error = ex
+            self.state = FAILED
+            self.progress(f"Failed to load the model: {ex}")
+            LOGGER.exception(ex)
+        finally:
+            self.loaded.set()
+
+    async def wait_ready(self, token: Optional[CancelToken] = None) -> None:
+        while not self.loaded.is_set():
+            if token is not None: token.raise_if_cancelled()
+            await asyncio.sleep(0.5)
+        if self.state == FAILED:
+            raise ModelLoadFailed(f"The model failed to load: {self.error}")
+
+    def close(self) -> None:
+        """ Release the model, e.g. stop its worker processes; a model still loading is released once built. """
+        self.closed = True
+        if hasattr(self.model, "close"): self.model.close()
+
+    def __call__(self, *args, **kwargs) -> Any:
+        token = current_token()
+        while not self.loaded.wait(0.5):
+            if token is not None: token.raise_if_cancelled()
+        if self.state == FAILED:
+            raise ModelLoadFailed(f"The model failed to load: {self.error}")
+        return self.model(*args, **kwargs)
@@ -0,0 +1,123 @@
+##### Libraries #####
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+import logging.handlers
+from typing import Any, Dict, Optional
+
+
+
+
+
+##### Parameters #####
+# "text" follows LOG_FMT, "json" writes one JSON object per line
+LOG_FORMAT        : str = os.getenv("LOG_FORMAT", "text")
+# Also write JSON lines here, e.g. for latency analysis, whatever LOG_FORMAT is
+LOG_FILE          : str = os.getenv("LOG_FILE", '')
+# Large contents passed as `extra={ "payload": ... }` are cut to this many chars...
+LOG_PAYLOAD_LIMIT : int = int(os.getenv("LOG_PAYLOAD_LIMIT", 300))
+# ...except in this fraction of the records, which keep it whole
+LOG_PAYLOAD_SAMPLE: float = float(os.getenv("LOG_PAYLOAD_SAMPLE", 0.0))
+REQUEST_ID: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+# Attributes every LogRecord has, anything else came from `extra`
+RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | { "message", "asctime" }
+
+
+
+
+
+##### Classes #####
+class TextFormatter(logging.Formatter):
+    """ The usual LOG_FMT line, with the request ID and payload appended when present. """
+    def format(self, record: logging.LogRecord) -> str:
+        return '\n' + super().format(record)
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        if getattr(record, "request_id", None): line += f" [{record.request_id}]"
+        if getattr(record, "payload", None) is not None: line += f"\n{record.payload}"
+        return line
+
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time"   : round(record.created, 3),
+            "level"  : record.levelname,
+            "logger" : record.name,
+            "message": record.getMessage(),
+            "where"  : f"{record.filename}:{record.funcName}:{record.lineno}",
+            "thread" : record.threadName,
+        }
+        entry.update({ key: value for key, value in vars(record).items()
+                       if key not in RECORD_ATTRS and value is not None })
+        if record.exc_info: entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread, which does the formatting and I/O.
+
+    Only what must be read on the calling thread happens here: the request
+    ID (a context variable) and the cut of the payload, so the cost of a
+    log call does not grow with the size of what is logged.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.request_id = getattr(record, "request_id", None) or REQUEST_ID.get()
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            payload = payload if isinstance(payload, str) else str(payload)
+            record.payload_chars = len(payload)
+            if len(payload) > LOG_PAYLOAD_LIMIT and random.random() >= LOG_PAYLOAD_SAMPLE:
+                payload = payload[:LOG_PAYLOAD_LIMIT] + f"... ({len(payload) - LOG_PAYLOAD_LIMIT} more chars)"
+        record.payload = payload
+        return record
+
+
+
+
+
+##### Functions #####
+_LISTENER: Optional[logging.handlers.QueueListener] = None
+_LOCK = threading.Lock()
+
+
+def setup_logging() -> None:
+    """ Route every logger through one queue to a single listener thread (idempotent). """
+    global _LISTENER
+    with _LOCK:
+        if _LISTENER is not None: return
+        console = logging.StreamHandler(sys.stderr)
+        if LOG_FORMAT == "json":
+            console.setFormatter(JsonFormatter())
+        else:
+            console.setFormatter(TextFormatter(os.environ["LOG_FMT"], datefmt=os.environ["LOG_DATE_FMT"]))
+        handlers = [ console ]
+        if LOG_FILE:
+            file = logging.FileHandler(LOG_FILE, encoding="utf-8")
+            file.setFormatter(JsonFormatter())
+            handlers.append(file)
+
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        logging.getLogger().addHandler(AsyncQueueHandler(records))
+        _LISTENER = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        _LISTENER.start()
+        atexit.register(_LISTENER.stop)  # Drain what is still queued
+
+
+def get_logger(name: str, level: int = logging.INFO) -> logging.Logger:
+    setup_logging()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    return logger
@@ -3,13 +3,16 @@ import os
 import json5
 import logging
 import requests
-import subprocess
 from bs4 import BeautifulSoup
 from typing import Union, Optional, Dict, List
 from qwen_agent.agents import Assistant
 from qwen_agent.utils.utils import extract_code
 from qwen_agent.llm.base import ModelServiceError
 from qwen_agent.tools.base import BaseTool, register_tool
+from . import PROJECTS_ROOT
+from .cancel import GenerationCancelled, close_on_cancel, iterate_cancellable, run_cancellable
+from .store import ConversationStore
+from .logs import get_logger
 
 
 
@@ -23,12 +26,7 @@ LOG_LEVEL: int = logging.INFO
 
 
 ##### Loggers #####
-LOGGER = logging.getLogger("Qwen")
-LOGGER.setLevel(LOG_LEVEL)
-HANDLER = logging.StreamHandler()
-HANDLER.setLevel(LOG_LEVEL)
-HANDLER.setFormatter(logging.Formatter('\n'+os.environ["LOG_FMT"], datefmt=os.environ["LOG_DATE_FMT"]))
-LOGGER.addHandler(HANDLER)
+LOGGER = get_logger("Qwen", LOG_LEVEL)
 
 
 
@@ -108,7 +106,7 @@ class ProjectManager(BaseTool):
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
-        self.root = "projects"
+        self.root = PROJECTS_ROOT
         os.makedirs(self.root, exist_ok=True)
         self.args_format = "Content应为Markdown代码块。"
 
@@ -168,32 +166,23 @@ class ProjectManager(BaseTool):
     def create(self, project_path: str) -> str:
         os.makedirs(project_path, exist_ok=True)
         command = ["python", "-m", "venv", "venv4W"]
-        completed_process = subprocess.run(command, text=True,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE,
-                                            cwd=project_path)
-        if completed_process.returncode != 0:
-            return completed_process.stderr
+        returncode, _, stderr = run_cancellable(command, cwd=project_path)
+        if returncode != 0:
+            return stderr
         if os.path.exists(f"{project_path}/requirements.txt"):
             command = ["cmd.exe", "/c", "venv4W\\bin\\activate", "&&",
                        "pip", "install", "-r", "requirements.txt"]
-            completed_process = subprocess.run(command, text=True,
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.PIPE,
-                                                cwd=project_path)
-        if completed_process.returncode != 0:
-            return completed_process.stderr
+            returncode, _, stderr = run_cancellable(command, cwd=project_path)
+        if returncode != 0:
+            return stderr
         else:
             return "SUCCESS"
         
     def install(self, project_path: str, command: str) -> str:
         command = ["cmd.exe", "/c", "venv4W\\Scripts\\activate", "&&"] + command.split(' ')
-        completed_process = subprocess.run(command, text=True,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE,
-                                            cwd=project_path)
-        if completed_process.returncode != 0:
-            return completed_process.stderr
+        returncode, _, stderr = run_cancellable(command, cwd=project_path)
+        if returncode != 0:
+            return stderr
         else:
             return "SUCCESS"
 
@@ -215,8 +204,9 @@ class ProjectManager(BaseTool):
         dir_info = list(os.walk(path))
         # Temp logic
         dir_info = list(filter(lambda t: "venv" not in t[0] and len(t[1]) < 10 and len(t[2]) < 10, dir_info))
-        print(dir_info)
-        return str(dir_info)
+        dir_info = str(dir_info)
+        LOGGER.debug(f"Walked \"{path}\".", extra={ "payload": dir_info })
+        return dir_info
 
 
 
@@ -238,7 +228,7 @@ class MyCodeExecutor(BaseTool):
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
-        self.root = "projects"
+        self.root = PROJECTS_ROOT
 
     def call(self, params: Union[str, dict], timeout: Optional[int] = 30, **kwargs) -> str:
         params = json5.loads(params)
@@ -247,21 +237,18 @@ class MyCodeExecutor(BaseTool):
         project_name, filename = params["project name"], params["filename"]
 
         command = ["cmd.exe", "/c", "venv4W\\Scripts\\activate", "&&", "python", filename ]
-        completed_process = subprocess.run(command, text=True,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE,
-                                            cwd=os.path.join(self.root, project_name))
+        returncode, stdout, stderr = run_cancellable(command, timeout=timeout,
+                                                     cwd=os.path.join(self.root, project_name))
         
-        if completed_process.returncode != 0:
-            return completed_process.stderr
+        if returncode != 0:
+            return stderr
         else:
-            result = completed_process.stdout
-            return result if result.strip() else "Finished execution."
+            return stdout if stdout.strip() else "Finished execution."
 
 
 
 class VllmDockerQwenAgent(Assistant):
-    def __init__(self, model_name, vllm_port):
+    def __init__(self, model_name, vllm_port, history_db: Optional[str] = None):
         llm_cfg = {
             "model": model_name,
             "model_server": f"http://localhost:{vllm_port}/v1",
@@ -275,60 +262,97 @@ class VllmDockerQwenAgent(Assistant):
             # system_message=system,
             # files=[ os.path.abspath("doc.pdf") ],
         )
+        # Closing the generators of `run` leaves the HTTP stream open, so the
+        # completion itself is closed when the request is cancelled
+        create = self.llm._chat_complete_create
+        self.llm._chat_complete_create = lambda *args, **kwargs: close_on_cancel(create(*args, **kwargs))
         # self.history_messages = [{
         #     "role": "system",
         #     "content": "When generating code, " + \
         #                "use '#' to write comment. " + \
         #                "Do not use triple quotes (\"\"\") to write comment."
         # }]
-        self.history_messages = []
-        
-    def __call__(self, msg: str) -> List[Dict]:
-        self.history_messages.append({ "role": "user", "content": msg })
-        if sum(len(m["content"]) for m in self.history_messages) > 5000:
-            self.remove_long_message()
+        # One history per conversation (Discord channel), loaded from the store on first use
+        self.histories: Dict[str, List[Dict]] = {}
+        self.store = ConversationStore(history_db) if history_db else None
+
+    def history(self, conversation: str) -> List[Dict]:
+        if conversation not in self.histories:
+            self.histories[conversation] = self.store.load(conversation) if self.store else []
+        return self.histories[conversation]
+
+    def forget(self, conversation: str) -> None:
+        """ Drop the in-memory copy; the stored turns are kept. """
+        self.histories.pop(conversation, None)
+
+    def close(self) -> None:
+        """ Write out the turns still queued for the store, e.g. before the process exits. """
+        if self.store: self.store.flush()
+
+    def __call__(self, msg: str, conversation: Optional[str] = "default") -> List[Dict]:
+        # `None` is a one-off conversation, neither kept nor stored
+        history_messages = self.history(conversation) if conversation is not None else []
+        user_message = { "role": "user", "content": msg }
+        history_messages.append(user_message)
+        rewritten = False
+        if sum(len(m["content"]) for m in history_messages) > 5000:
+            rewritten = self.remove_long_message(history_messages)
         while True:
             try:
-                for response_list in self.run(messages=self.history_messages):
+                # Streamed, so a cancellation is noticed between tokens and
+                # closes the underlying vLLM request instead of waiting for it.
+                for response_list in iterate_cancellable(self.run(messages=history_messages)):
                     pass
                 break
+            except GenerationCancelled:
+                # Drop the unanswered turn so the next request starts clean
+                history_messages.pop()
+                raise
             except ModelServiceError as ex:
-                print(type(ex), ex)
-                print(type(ex.message), ex.message)
-                if "max_tokens must be at least 1" in ex.message:
-                    if self.remove_long_message():
+                message = ex.message or str(ex)
+                LOGGER.warning(f"{type(ex).__name__} from the model service.", extra={ "payload": message })
+                if "max_tokens must be at least 1" in message:
+                    if self.remove_long_message(history_messages):
+                        rewritten = True
                         LOGGER.info("The length of history messages is too long. Removed some messages.")
                     else:
                         raise Exception("Special case?: ", ex)
+                elif ex.exception is not None:
+                    # The openai error it wraps, e.g. APIConnectionError while the server is down
+                    raise ex.exception
                 else:
                     raise ex
 
         for response in response_list:
-
-            print('\n', type(response), response, '\n')
-
+            LOGGER.debug(f"Response of role \"{response.get('role')}\".",
+                         extra={ "tool": response.get("name"), "payload": response.get("content") })
             if response.get("name", '') == "my_web_extractor":
                 response["content"] = "Deleted for saving memory. Extract again if needed."
             if response.get("name", '') == "project_manager":
                 response["content"] = f"```python\n{response['content']}```"
                 # if len(response["content"]) > 100:
                 #     response["content"] = "Deleted for saving memory."
-            self.history_messages.append(response)
+            history_messages.append(response)
+
+        if self.store and conversation is not None:
+            # A trimmed history no longer extends the stored one, so it replaces it
+            if rewritten: self.store.snapshot(conversation, history_messages)
+            else:         self.store.append(conversation, [ user_message ] + response_list)
         return response_list
     
 
     # Temp logic
-    def remove_long_message(self) -> None:
-        for msg_id in range(len(self.history_messages)):
+    def remove_long_message(self, history_messages: List[Dict]) -> bool:
+        for msg_id in range(len(history_messages)):
             if msg_id <= 1: pass
-            if self.history_messages[msg_id]["role"] != "user" and \
-               len(self.history_messages[msg_id]["content"]) > 500:
-                self.history_messages[msg_id]["content"] = "Deleted for saving memory."
-                return
-        for _ in range(5): self.history_messages.pop(2)
-        self.history_messages.insert(
+            if history_messages[msg_id]["role"] != "user" and \
+               len(history_messages[msg_id]["content"]) > 500:
+                history_messages[msg_id]["content"] = "Deleted for saving memory."
+                return True
+        for _ in range(5): history_messages.pop(2)
+        history_messages.insert(
             2, { "role": "system", "content": "5 messages are deleted for saving memory." })
-        return
+        return True
 
 
 
@@ -0,0 +1,70 @@
+##### Libraries #####
+import sys
+import time
+import logging
+import contextlib
+from typing import Iterator, List, Set, Tuple
+from .logs import get_logger
+
+
+
+
+
+##### Parameters #####
+LOG_LEVEL: int = logging.INFO
+
+
+
+
+
+##### Loggers #####
+LOGGER = get_logger("Startup", LOG_LEVEL)
+
+
+
+
+
+##### Functions #####
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+
+
+
+##### Classes #####
+class StartupProfile(object):
+    """
+    Records the duration of each boot stage and reports them at each milestone.
+
+    Stages may be recorded from the model loading thread too, so the
+    "Model ready" report also covers the backend import and build.
+    """
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.reported: Set[str] = set()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - stage_start))
+
+    def report(self, milestone: str = "Discord ready") -> None:
+        if milestone in self.reported: return
+        self.reported.add(milestone)
+        stages = list(self.stages)
+        width = max([ len(name) for name, _ in stages ] + [ len(milestone) ])
+        lines = [ f"{name:<{width}} : {secs:7.3f} s" for name, secs in stages ]
+        lines.append(f"{milestone:<{width}} : {time.perf_counter() - self.start:7.3f} s (total)")
+        lines.append(f"{'Peak RSS':<{width}} : {peak_rss_mb():7.1f} MB")
+        LOGGER.info("Startup profile:\n" + '\n'.join(lines))
@@ -0,0 +1,152 @@
+##### Libraries #####
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Tuple
+from .logs import get_logger
+
+
+
+
+
+##### Parameters #####
+LOG_LEVEL: int = logging.INFO
+TURN    : str = "turn"      # Messages appended to a conversation
+SNAPSHOT: str = "snapshot"  # Whole conversation after it was rewritten, e.g. trimmed
+SCHEMA  : str = """
+CREATE TABLE IF NOT EXISTS events (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation TEXT    NOT NULL,
+    kind         TEXT    NOT NULL,
+    payload      TEXT    NOT NULL,
+    created      REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_conversation ON events (conversation, id);
+"""
+
+
+
+
+
+##### Loggers #####
+LOGGER = get_logger("Store", LOG_LEVEL)
+
+
+
+
+
+##### Functions #####
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # Durable at checkpoints, no fsync per commit
+    return conn
+
+
+
+
+
+##### Classes #####
+class ConversationStore(object):
+    """
+    Append-only SQLite (WAL) log of conversation turns and tool results.
+
+    Writes are queued and committed in batches by a background thread, so
+    the caller never waits on the disk. Nothing is read at startup: a
+    conversation is loaded the first time it is used, starting from its
+    latest snapshot, and `compact` drops the events a snapshot superseded.
+    """
+    def __init__(
+            self,
+            path: str,
+            batch_size: int = 256,
+            compact_interval: float = 3600.0,
+        ) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.compact_interval = compact_interval
+        self.writes: queue.Queue = queue.Queue()
+        self.read_lock = threading.Lock()
+        self.read_conn = connect(path)
+        self.read_conn.executescript(SCHEMA)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        # The writer is a daemon thread, whatever it has not committed at exit is lost
+        atexit.register(self.flush)
+
+    def append(self, conversation: str, messages: List[Dict]) -> None:
+        # Serialized now, the caller may keep mutating the dicts afterwards
+        self.writes.put((conversation, TURN, json.dumps(messages, ensure_ascii=False)))
+
+    def snapshot(self, conversation: str, messages: List[Dict]) -> None:
+        self.writes.put((conversation, SNAPSHOT, json.dumps(messages, ensure_ascii=False)))
+
+    def flush(self) -> None:
+        self.writes.join()
+
+    def load(self, conversation: str) -> List[Dict]:
+        self.flush()
+        with self.read_lock:
+            row = self.read_conn.execute(
+                "SELECT MAX(id) FROM events WHERE conversation = ? AND kind = ?",
+                (conversation, SNAPSHOT)).fetchone()
+            rows = self.read_conn.execute(
+                "SELECT kind, payload FROM events WHERE conversation = ? AND id >= ? ORDER BY id",
+                (conversation, row[0] or 0)).fetchall()
+        messages: List[Dict] = []
+        for kind, payload in rows:
+            if kind == SNAPSHOT: messages = json.loads(payload)
+            else:                messages.extend(json.loads(payload))
+        if messages: LOGGER.info(f"Loaded {len(messages)} message(s) of conversation \"{conversation}\".")
+        return messages
+
+    def compact(self) -> None:
+        """ Queue the removal of every event older than its conversation's latest snapshot. """
+        self.writes.put(None)
+
+    def write_loop(self) -> None:
+        conn = connect(self.path)
+        last_compact = time.monotonic()
+        while True:
+            try:
+                items = [ self.writes.get(timeout=self.compact_interval) ]
+            except queue.Empty:
+                items = []
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                events = [ (*item, time.time()) for item in items if item is not None ]
+                if events:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO events (conversation, kind, payload, created) VALUES (?, ?, ?, ?)", events)
+                if None in items or time.monotonic() - last_compact >= self.compact_interval:
+                    self.compact_now(conn)
+                    last_compact = time.monotonic()
+            except sqlite3.Error as ex:
+                LOGGER.error(f"Failed to write {len(items)} event(s) to \"{self.path}\": {ex}")
+            finally:
+                for _ in items: self.writes.task_done()
+
+    def compact_now(self, conn: sqlite3.Connection) -> None:
+        with conn:
+            deleted = conn.execute("""
+                DELETE FROM events WHERE id < (
+                    SELECT MAX(snapshots.id) FROM events AS snapshots
+                    WHERE snapshots.conversation = events.conversation AND snapshots.kind = ?
+                )""", (SNAPSHOT,)).rowcount
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if deleted: LOGGER.info(f"Compacted {deleted} superseded event(s).")
+
+    def stats(self) -> Tuple[int, int]:
+        """ (conversations, events) currently stored. """
+        with self.read_lock:
+            return self.read_conn.execute(
+                "SELECT COUNT(DISTINCT conversation), COUNT(*) FROM events").fetchone()
@@ -0,0 +1,321 @@
+##### Libraries #####
+import time
+import zlib
+import json
+import queue
+import struct
+import logging
+import importlib
+import itertools
+import threading
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from .cancel import CancelToken, GenerationCancelled, call_with_token, current_token
+from .logs import REQUEST_ID, get_logger
+
+
+
+
+
+##### Parameters #####
+LOG_LEVEL: int = logging.INFO
+
+# Frame = header (kind, request ID) + UTF-8 JSON body.
+# `Connection.send_bytes` already length-prefixes every frame.
+HEADER = struct.Struct("!BI")
+CALL   : int = 1  # parent -> worker: { "method": str | null, "args": [...], "kwargs": {...}, "request_id": str | null }
+CANCEL : int = 2  # parent -> worker: { "reason": str }
+CHUNK  : int = 3  # worker -> parent: one streamed piece of the result
+DONE   : int = 4  # worker -> parent: final result (null after chunks)
+ERROR  : int = 5  # worker -> parent: { "type": str, "message": str }
+READY  : int = 6  # worker -> parent: model loaded
+STOP   : int = 7  # parent -> worker: shut down
+PROGRESS: int = 8  # worker -> parent: model loading stage
+# Secs the workers get to finish after STOP before they are killed
+CLOSE_TIMEOUT: float = 10.0
+
+
+
+
+
+##### Loggers #####
+LOGGER = get_logger("Worker", LOG_LEVEL)
+
+
+
+
+
+##### Functions #####
+def send_frame(conn: Connection, kind: int, request_id: int, body: Any = None) -> None:
+    conn.send_bytes(HEADER.pack(kind, request_id) + json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+
+def recv_frame(conn: Connection) -> Tuple[int, int, Any]:
+    frame = conn.recv_bytes()
+    kind, request_id = HEADER.unpack_from(frame)
+    return kind, request_id, json.loads(frame[HEADER.size:])
+
+
+def worker_main(
+        conn: Connection,
+        module_name: str,
+        class_name: str,
+        kwargs: Dict,
+        report_progress: bool = False,
+    ) -> None:
+    """ Entry point of a worker process: load the model, then serve calls one at a time. """
+    send_lock = threading.Lock()
+    def send(kind: int, request_id: int, body: Any = None) -> None:
+        with send_lock: send_frame(conn, kind, request_id, body)
+
+    try:
+        model_class = getattr(importlib.import_module(module_name), class_name)
+        if report_progress:
+            kwargs = { **kwargs, "progress": lambda stage: send(PROGRESS, 0, stage) }
+        model = model_class(**kwargs)
+    except Exception as ex:
+        send(ERROR, 0, { "type": type(ex).__name__, "message": f"Failed to load model: {ex}" })
+        return
+    send(READY, 0)
+
+    tokens: Dict[int, CancelToken] = {}
+    calls: queue.Queue = queue.Queue()
+
+    def execute() -> None:
+        # The GPU is the bottleneck, so calls are served sequentially
+        while True:
+            request_id, body = calls.get()
+            if request_id is None: return
+            token = tokens[request_id]
+            target = model if body["method"] is None else getattr(model, body["method"], None)
+            try:
+                if target is None:
+                    send(DONE, request_id, None)
+                    continue
+                REQUEST_ID.set(body.get("request_id"))  # Same request ID in the worker's logs
+                result = call_with_token(token, target, *body["args"], **body["kwargs"])
+                if isinstance(result, Iterator):
+                    for piece in result:
+                        token.raise_if_cancelled()
+                        send(CHUNK, request_id, piece)
+                    result = None
+                send(DONE, request_id, result)
+            except GenerationCancelled as ex:
+                send(ERROR, request_id, { "type": "GenerationCancelled", "message": ex.reason })
+            except Exception as ex:
+                send(ERROR, request_id, { "type": type(ex).__name__, "message": str(ex) })
+            finally:
+                tokens.pop(request_id, None)
+
+    executor = threading.Thread(target=execute, daemon=True)
+    executor.start()
+    while True:
+        try:
+            kind, request_id, body = recv_frame(conn)
+        except EOFError:
+            break
+        if kind == CALL:
+            tokens[request_id] = CancelToken()
+            calls.put((request_id, body))
+        elif kind == CANCEL:
+            token = tokens.get(request_id)
+            if token is not None: token.cancel(body["reason"])
+        elif kind == STOP:
+            break
+    for token in list(tokens.values()): token.cancel("Worker is shutting down.")
+    calls.put((None, None))
+    executor.join()
+    # Unlike the gateway, a worker process does not run atexit handlers
+    if hasattr(model, "close"): model.close()
+
+
+
+
+
+##### Classes #####
+class WorkerCrashed(Exception):
+    pass
+
+
+
+class WorkerError(Exception):
+    def __init__(self, error_type: str, message: str) -> None:
+        super().__init__(f"{error_type}: {message}")
+        self.error_type = error_type
+
+
+
+class _WorkerHandle(object):
+    def __init__(
+            self,
+            module_name: str,
+            class_name: str,
+            kwargs: Dict,
+            progress: Optional[Callable[[str], None]] = None,
+        ) -> None:
+        context = multiprocessing.get_context("spawn")  # CUDA cannot be forked
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, daemon=True,
+                                       args=(child_conn, module_name, class_name,
+                                             kwargs, progress is not None))
+        self.process.start()
+        child_conn.close()
+        self.progress = progress
+        self.ready = threading.Event()
+        self.alive = True
+        self.error: Optional[str] = None
+        self.pending: Dict[int, queue.Queue] = {}
+        self.send_lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+    def send(self, kind: int, request_id: int, body: Any = None) -> None:
+        with self.send_lock: send_frame(self.conn, kind, request_id, body)
+
+    def cancel(self, request_id: int, reason: str) -> None:
+        if not self.alive: return
+        try:
+            self.send(CANCEL, request_id, { "reason": reason })
+        except OSError:
+            pass
+
+    def read(self) -> None:
+        while True:
+            try:
+                kind, request_id, body = recv_frame(self.conn)
+            except (EOFError, OSError):
+                break
+            if kind == READY:
+                self.ready.set()
+                LOGGER.info(f"Inference worker (pid {self.process.pid}) is ready.")
+            elif kind == PROGRESS:
+                if self.progress is not None: self.progress(body)
+            elif request_id == 0 and kind == ERROR:
+                self.error = body["message"]
+                LOGGER.error(f"Inference worker (pid {self.process.pid}) failed: {body['message']}")
+            elif request_id in self.pending:
+                self.pending[request_id].put((kind, body))
+        # EOF: the worker exited or crashed, fail whatever it was still serving
+        self.alive = False
+        self.process.join(timeout=5)
+        LOGGER.log(logging.INFO if self.process.exitcode == 0 else logging.WARNING,
+                   f"Inference worker (pid {self.process.pid}) exited with code {self.process.exitcode}.")
+        for pending in list(self.pending.values()):
+            pending.put((ERROR, { "type": "WorkerCrashed",
+                                  "message": f"Inference worker exited with code {self.process.exitcode}." }))
+
+    def stop(self) -> None:
+        if not self.alive: return
+        try:
+            self.send(STOP, 0)
+        except OSError:
+            pass
+
+    def close(self, timeout: float = CLOSE_TIMEOUT) -> None:
+        self.stop()
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            # Not SIGTERM, which the model may swallow, e.g. Qwen-Agent installs its own handler
+            LOGGER.warning(f"Inference worker (pid {self.process.pid}) did not stop in time, killing it.")
+            self.process.kill()
+            self.process.join()
+
+
+
+class WorkerModel(object):
+    """
+    Hosts `module_name.class_name(**kwargs)` in `num_workers` separate processes,
+    so tokenization, `generate` and decoding never hold the gateway's GIL.
+
+    Callable like the wrapped model. A crashed worker fails only the requests
+    it was serving and is respawned on the next call.
+    """
+    def __init__(
+            self,
+            module_name: str,
+            class_name: str,
+            kwargs: Optional[Dict] = None,
+            num_workers: int = 1,
+            progress: Optional[Callable[[str], None]] = None,
+        ) -> None:
+        self.module_name = module_name
+        self.class_name = class_name
+        self.kwargs = kwargs or {}
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.workers: List[_WorkerHandle] = [ self.spawn() for _ in range(num_workers) ]
+
+    def spawn(self) -> _WorkerHandle:
+        handle = _WorkerHandle(self.module_name, self.class_name, self.kwargs, self.progress)
+        LOGGER.info(f"Spawned inference worker (pid {handle.process.pid}) for \"{self.class_name}\".")
+        return handle
+
+    def pick_worker(self, affinity: Optional[str] = None) -> _WorkerHandle:
+        """ Least busy worker, or always the same one for the same `affinity` key. """
+        with self.lock:
+            for worker_id, worker in enumerate(self.workers):
+                if not worker.alive: self.workers[worker_id] = self.spawn()
+            if affinity is not None:
+                return self.workers[zlib.crc32(affinity.encode("utf-8")) % len(self.workers)]
+            return min(self.workers, key=lambda worker: len(worker.pending))
+
+    def wait_ready(self) -> None:
+        """ Block until one worker has loaded the model, raise if all of them failed. """
+        while not any(worker.ready.is_set() for worker in self.workers):
+            if not any(worker.alive for worker in self.workers):
+                errors = [ worker.error for worker in self.workers if worker.error ]
+                raise WorkerError("LoadFailed", '; '.join(errors) or "All inference workers exited.")
+            time.sleep(0.5)
+
+    def warmup(self) -> None:
+        for worker in self.workers:
+            for _ in self.request(worker, "warmup", (), {}): pass
+
+    def request(self, worker: _WorkerHandle, method: Optional[str], args: tuple, kwargs: Dict) -> Iterator[Any]:
+        request_id = next(self.request_ids)
+        responses: queue.Queue = queue.Queue()
+        worker.pending[request_id] = responses
+        token = current_token()
+        unregister = token.on_cancel(lambda: worker.cancel(request_id, token.reason)) \
+            if token is not None else (lambda: None)
+        try:
+            try:
+                worker.send(CALL, request_id, { "method": method, "args": list(args), "kwargs": kwargs,
+                                                "request_id": REQUEST_ID.get() })
+            except OSError as ex:
+                worker.alive = False
+                raise WorkerCrashed(f"Inference worker is unreachable: {ex}")
+            while True:
+                kind, body = responses.get()
+                if kind == CHUNK:
+                    yield body
+                elif kind == DONE:
+                    if body is not None: yield body
+                    return
+                elif body["type"] == "GenerationCancelled":
+                    raise GenerationCancelled(body["message"])
+                elif body["type"] == "WorkerCrashed":
+                    raise WorkerCrashed(body["message"])
+                else:
+                    raise WorkerError(body["type"], body["message"])
+        finally:
+            unregister()
+            worker.pending.pop(request_id, None)
+
+    def stream(self, *args, **kwargs) -> Iterator[Any]:
+        """ Yield the streamed pieces of a call; a non-streaming result is yielded once. """
+        # A conversation's history lives in one worker, so keep sending it there
+        return self.request(self.pick_worker(kwargs.get("conversation")), None, args, kwargs)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        pieces = list(self.stream(*args, **kwargs))
+        if len(pieces) == 1: return pieces[0]
+        return ''.join(pieces)
+
+    def close(self) -> None:
+        """ Stop every worker, killing those still busy after `CLOSE_TIMEOUT` secs. """
+        for worker in self.workers: worker.stop()
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        for worker in self.workers: worker.close(max(0.0, deadline - time.monotonic()))
@@ -3,47 +3,82 @@ import dotenv
 dotenv.load_dotenv(".env")
 import os
 os.environ["HF_HOME"] = os.getenv("HF_HOME")
+from libs.logs import REQUEST_ID, get_logger
+from libs.startup import StartupProfile
+STARTUP = StartupProfile()
 import time
 import json
-import json5
-import openai
 import typing
 import asyncio
-import discord
 import logging
 import functools
 import subprocess
-from discord.threads import Thread
 from typing import Union, List, Dict
-from qwen_agent.utils.utils import extract_code
-from libs import (
-    HfBaseModel,
-    HfZephyr7bBeta,
-    HfQwen,
-    HfDeepseekCoderInstruct,
-    VllmDockerLcModel,
-    VllmDockerQwenAgent,
-)
-from discord.channel import (
-    TextChannel,
-    DMChannel,
-    GroupChannel,
-    PartialMessageable,
-    VoiceChannel,
-    StageChannel,
+with STARTUP.stage("import openai"):
+    import openai
+with STARTUP.stage("import discord"):
+    import discord
+    from discord.threads import Thread
+    from discord.channel import (
+        TextChannel,
+        DMChannel,
+        GroupChannel,
+        PartialMessageable,
+        VoiceChannel,
+        StageChannel,
+    )
+from libs import BACKENDS, resolve_backend
+from libs.worker import WorkerModel, WorkerCrashed, WorkerError
+from libs.loader import BackgroundModel, ModelLoadFailed
+from libs.delivery import DeliveryEngine
+from libs.ingest import AttachmentIngester
+from libs.cancel import CancelToken, GenerationCancelled, call_with_token
+from libs.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    PRIORITY_COMMAND,
+    PRIORITY_CHAT,
+    PRIORITY_AGENT,
 )
+if typing.TYPE_CHECKING:
+    # Backends are imported on demand by `resolve_backend`, see libs/__init__.py
+    from libs.hf import HfBaseModel
+    from libs.lc import VllmDockerLcModel
+    from libs.qwen import VllmDockerQwenAgent
 MessageableChannel = Union[TextChannel, VoiceChannel, StageChannel, Thread,
                            DMChannel, PartialMessageable, GroupChannel]
-VllmDockerModel    = Union[VllmDockerLcModel, VllmDockerQwenAgent]
+VllmDockerModel    = Union["VllmDockerLcModel", "VllmDockerQwenAgent", WorkerModel, BackgroundModel]
+Model              = Union["HfBaseModel", VllmDockerModel]
 
 
 
 
 ##### Parameters #####
+BACKEND       : str = str(os.getenv("BACKEND", "vllm_qwen"))
 MODEL_NAME    : str = str(os.getenv("MODEL_NAME"))
 MAX_MODEL_LEN : int = int(os.getenv("MAX_MODEL_LEN"))
 VLLM_PORT     : int = int(os.getenv("VLLM_PORT"))
 DISCORD_TOKEN : str = str(os.getenv("DISCORD_TOKEN"))
+# Deadline of a single generation in secs, 0 disables it
+REQUEST_TIMEOUT: float = float(os.getenv("REQUEST_TIMEOUT", 600))
+CANCEL_EMOJI  : str = "\N{CROSS MARK}"
+LIFECYCLE_COMMANDS: List[str] = [ "!Start", "!Restart", "!ForceRestart", "!Stop" ]
+HF_BACKENDS         : List[str] = [ "hf_zephyr", "hf_qwen", "hf_deepseek" ]
+VLLM_DOCKER_BACKENDS: List[str] = [ "vllm_lc", "vllm_qwen" ]
+AGENT_BACKENDS      : List[str] = [ "vllm_qwen" ]
+# Admission control, see libs/admission.py
+MAX_ACTIVE_REQUESTS     : int = int(os.getenv("MAX_ACTIVE_REQUESTS", 1))
+MAX_QUEUED_REQUESTS     : int = int(os.getenv("MAX_QUEUED_REQUESTS", 16))
+MAX_REQUESTS_PER_USER   : int = int(os.getenv("MAX_REQUESTS_PER_USER", 2))
+MAX_REQUESTS_PER_CHANNEL: int = int(os.getenv("MAX_REQUESTS_PER_CHANNEL", 1))
+# Prompts up to this length are served before longer prompts and uploads
+SHORT_PROMPT_CHARS      : int = int(os.getenv("SHORT_PROMPT_CHARS", 200))
+# Number of separate inference processes hosting the model, 0 runs it in the bot process
+INFERENCE_WORKERS       : int = int(os.getenv("INFERENCE_WORKERS", 0))
+# Run one tiny generation after loading to compile kernels and fill caches
+MODEL_WARMUP            : bool = os.getenv("MODEL_WARMUP", "0") == "1"
+# SQLite file keeping the agent's conversations across restarts, empty keeps them in memory only
+HISTORY_DB              : str = str(os.getenv("HISTORY_DB", "history.db"))
 DC_LOG_LEVEL  : int = logging.WARNING
 MAIN_LOG_LEVEL: int = logging.INFO
 # MAIN_LOG_LEVEL: int = logging.DEBUG
@@ -53,16 +88,8 @@ MAIN_LOG_LEVEL: int = logging.INFO
 
 
 ##### Loggers #####
-DC_LOGGER = logging.getLogger("discord")
-DC_LOGGER.addHandler(logging.StreamHandler())
-DC_LOGGER.setLevel(DC_LOG_LEVEL)
-
-MAIN_LOGGER = logging.getLogger("Main")
-MAIN_LOGGER.setLevel(MAIN_LOG_LEVEL)
-MAIN_HANDLER = logging.StreamHandler()
-MAIN_HANDLER.setLevel(MAIN_LOG_LEVEL)
-MAIN_HANDLER.setFormatter(logging.Formatter('\n'+os.environ["LOG_FMT"], datefmt=os.environ["LOG_DATE_FMT"]))
-MAIN_LOGGER.addHandler(MAIN_HANDLER)
+DC_LOGGER = get_logger("discord", DC_LOG_LEVEL)
+MAIN_LOGGER = get_logger("Main", MAIN_LOG_LEVEL)
 
 
 
@@ -86,11 +113,24 @@ async def log_and_send(
     return
 
 
+def is_server_down(ex: Exception) -> bool:
+    # With inference workers, the openai error crosses the pipe as a `WorkerError`
+    if isinstance(ex, WorkerError): return ex.error_type in ("APIConnectionError", "APITimeoutError")
+    return isinstance(ex, openai.APIConnectionError)
+
+
+def ping(model: VllmDockerModel) -> None:
+    # The agent answers in a one-off conversation, so the probes do not end up in the history
+    model(":)", **({ "conversation": None } if BACKEND in AGENT_BACKENDS else {}))
+
+
+@to_thread
 def check_server_is_started(model: VllmDockerModel) -> bool:
     try:
-        model(":)")
+        ping(model)
         return True
-    except openai.APIConnectionError:
+    except (openai.APIConnectionError, WorkerError) as ex:
+        if not is_server_down(ex): raise
         return False
 
 
@@ -101,9 +141,10 @@ def report_server_started(model: VllmDockerModel) -> None:
     time.sleep(first_sleep_time)
     while True:
         try:
-            model(":)")
+            ping(model)
             return
-        except openai.APIConnectionError:
+        except (openai.APIConnectionError, WorkerError) as ex:
+            if not is_server_down(ex): raise
             MAIN_LOGGER.debug("Docker is still starting... sleep for 5 secs.")
             time.sleep(5)
 
@@ -113,7 +154,7 @@ async def start_docker(
         channel: MessageableChannel
     ) -> None:
     await log_and_send(channel, "Checking the docker is started or not...")
-    if check_server_is_started(model):
+    if await check_server_is_started(model):
         await log_and_send(channel, "The docker is already started!")
     else:
         await log_and_send(channel, "Starting the docker... This takes about 6 minutes.")
@@ -128,11 +169,11 @@ async def restart_docker(
         channel: MessageableChannel
     ) -> None:
     await log_and_send(channel, "Checking the docker is started or not...")
-    if check_server_is_started(model):
+    if await check_server_is_started(model):
         await log_and_send(channel, "Restarting the docker... This takes about 6 minutes.")
         await channel.send("**[SYSTEM]** *I will notice you when the docker is successfully restarted.*")
         subprocess.check_call(args=[ "docker-compose", "-f", "docker-compose.yml", "restart" ])
-        await report_server_started(model, channel)
+        await report_server_started(model)
         await log_and_send(channel, "The docker has successfully restarted!")
     else:
         await log_and_send(channel, "The docker isn't started yet, please use the command \"!Start\" instead.")
@@ -145,7 +186,7 @@ async def force_restart_docker(
     await log_and_send(channel, "Force restarting the docker... This takes about 6 minutes.\n" + \
                                         "I will notice you when the docker is successfully restarted.")
     subprocess.check_call(args=[ "docker-compose", "-f", "docker-compose.yml", "restart" ])
-    await report_server_started(model, channel)
+    await report_server_started(model)
     await log_and_send(channel, "The docker has successfully restarted!")
 
 
@@ -158,24 +199,52 @@ async def stop_docker(
     await log_and_send(channel, "The docker has successfully stopped!")
 
 
-def split_message(message: str) -> List[str]:
-    if len(message) <= 1900: return [ message ]
-    split_messages = [ '' ]
-    in_markdown = False
-    markdown_python = False
-    for msg in message.split('\n'):
-        if len(split_messages[-1]) + len(msg) <= 1900:
-            split_messages[-1] += msg+'\n'
-            if "```" in msg:
-                in_markdown = not in_markdown
-                markdown_python = in_markdown and "```py" in msg
-        else:
-            if in_markdown:
-                split_messages[-1] += "```"
-                msg = f"```py\n{msg}" if markdown_python else f"```{msg}"
-            split_messages.append(msg+'\n')
-    MAIN_LOGGER.debug(f"Response was splitted into {len(split_messages)} slices.")
-    return split_messages
+def backend_kwargs(backend: str) -> Dict:
+    if backend == "vllm_qwen":
+        return { "model_name": MODEL_NAME, "vllm_port": VLLM_PORT, "history_db": HISTORY_DB or None }
+    elif backend == "vllm_lc":
+        return { "model_name": MODEL_NAME, "max_tokens": MAX_MODEL_LEN, "port": VLLM_PORT }
+    else:
+        return {}
+
+
+def build_model(backend: str, progress: typing.Callable[[str], None]) -> Model:
+    """
+    Runs in the `BackgroundModel` thread, `progress` reports the loading stage.
+    The backend module must already be imported, see `start_model`.
+    """
+    kwargs = backend_kwargs(backend)
+    if INFERENCE_WORKERS > 0:
+        # The gateway only relays messages, the model lives in the worker processes
+        module_name, class_name = BACKENDS[backend]
+        progress(f"Spawning {INFERENCE_WORKERS} inference worker(s)...")
+        with STARTUP.stage(f"spawn {INFERENCE_WORKERS} {class_name} worker(s)"):
+            model = WorkerModel(module_name, class_name, kwargs, num_workers=INFERENCE_WORKERS,
+                                progress=progress if backend in HF_BACKENDS else None)
+            model.wait_ready()
+        return model
+    if backend in HF_BACKENDS: kwargs["progress"] = progress
+    model_class = resolve_backend(backend)
+    progress(f"Building {model_class.__name__}...")
+    with STARTUP.stage(f"build {model_class.__name__}"):
+        return model_class(**kwargs)
+
+
+def start_model(backend: str, profile: typing.Optional[StartupProfile] = None) -> BackgroundModel:
+    """
+    Import the backend on the calling (main) thread, then build the model in the background.
+
+    Some backends cannot be imported from another thread, e.g. Qwen-Agent's
+    code interpreter installs signal handlers at import time. The import is
+    cheap next to loading the weights, which stays in the thread with the
+    construction and the warm-up.
+    """
+    if INFERENCE_WORKERS == 0:
+        with STARTUP.stage(f"import {BACKENDS[backend][0]}"):
+            resolve_backend(backend)
+    model = BackgroundModel(functools.partial(build_model, backend), warmup=MODEL_WARMUP, profile=profile)
+    model.start()
+    return model
 
 
 def process_qwen_response_list(response_list: List[Dict]) -> List[Dict]:
@@ -219,25 +288,120 @@ def process_qwen_response_list(response_list: List[Dict]) -> List[Dict]:
 class DiscordBot(discord.Client):
     def __init__(
             self,
-            model: HfBaseModel | VllmDockerModel,
+            model: BackgroundModel,
+            backend: str,
             intents: discord.Intents,
             **options: dotenv.Any
         ) -> None:
         super().__init__(intents=intents, **options)
         self.model = model
+        self.backend = backend
+        # Cancel tokens of the queued and running requests, keyed by the request message ID
+        self.in_flight: Dict[int, CancelToken] = {}
+        self.admission = AdmissionController(
+            max_active=MAX_ACTIVE_REQUESTS,
+            max_queue=MAX_QUEUED_REQUESTS,
+            max_per_user=MAX_REQUESTS_PER_USER,
+            max_per_channel=MAX_REQUESTS_PER_CHANNEL,
+        )
+        self.delivery = DeliveryEngine()
+        self.ingester: typing.Optional[AttachmentIngester] = None
 
     async def on_ready(self) -> None:
         MAIN_LOGGER.info(f"Discord bot \"{self.user}\" connected!")
+        STARTUP.report()
+
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent) -> None:
+        if payload.user_id != int(os.getenv("USER_ID")): return
+        if str(payload.emoji) != CANCEL_EMOJI: return
+        token = self.in_flight.get(payload.message_id)
+        if token is not None:
+            token.cancel("Cancelled by reaction.")
+
+    def cancel_channel(self, channel_id: int) -> int:
+        tokens = [ token for token in self.in_flight.values() if token.channel_id == channel_id ]
+        for token in tokens: token.cancel("Cancelled by \"!Cancel\".")
+        return len(tokens)
+
+    def request_priority(self, dc_msg: discord.message.Message) -> int:
+        """ Ranked per message, so a short question overtakes queued agent runs. """
+        # Only the vLLM backends run the commands, the others answer them like any prompt
+        if self.backend in VLLM_DOCKER_BACKENDS and dc_msg.content in LIFECYCLE_COMMANDS:
+            return PRIORITY_COMMAND
+        if dc_msg.attachments or len(dc_msg.content) > SHORT_PROMPT_CHARS: return PRIORITY_AGENT
+        return PRIORITY_CHAT
+
+    async def generate(self, token: CancelToken, *args, **kwargs) -> typing.Any:
+        """
+        Call the model off the event loop, so that "!Cancel", reactions and other
+        channels are still served while generating. The cancel token reaches
+        the backend through `libs.cancel.CURRENT_TOKEN`.
+        """
+        await self.model.wait_ready(token)
+        token.raise_if_cancelled()
+        token.set_timeout(REQUEST_TIMEOUT)
+        timer = asyncio.get_running_loop().call_later(
+            REQUEST_TIMEOUT, token.cancel, "Deadline exceeded.") if REQUEST_TIMEOUT > 0 else None
+        try:
+            return await asyncio.to_thread(call_with_token, token, self.model, *args, **kwargs)
+        finally:
+            if timer is not None: timer.cancel()
 
     async def on_message(self, dc_msg: discord.message.Message) -> None:
         # Prevent the bot from replying its own message
         if dc_msg.author.id != int(os.getenv("USER_ID")): return
+        # Tags every record logged for this message, also from the model thread
+        REQUEST_ID.set(str(dc_msg.id))
         MAIN_LOGGER.debug(f"dc_msg: {dc_msg}")
         message = dc_msg.content
-        message_pruned = message[:20] + "..." if len(message) > 20 else message
-        MAIN_LOGGER.info(f"Received message: \"{message_pruned}\" from \"{dc_msg.author.name}\".")
+        MAIN_LOGGER.info(f"Received message from \"{dc_msg.author.name}\".",
+                         extra={ "channel_id": dc_msg.channel.id, "payload": message })
 
-        if type(self.model) is VllmDockerModel:
+        if message == "!Cancel":
+            cancelled_num = self.cancel_channel(dc_msg.channel.id)
+            await log_and_send(dc_msg.channel, f"Cancelled {cancelled_num} request(s)." \
+                               if cancelled_num else "There is no request to cancel.")
+            return
+
+        # Shed load with an immediate reply instead of letting requests time out
+        try:
+            ticket = self.admission.submit(
+                dc_msg.author.id, dc_msg.channel.id, self.request_priority(dc_msg))
+        except AdmissionRejected as ex:
+            await log_and_send(dc_msg.channel, str(ex), logging.WARNING)
+            return
+
+        token = CancelToken(channel_id=dc_msg.channel.id)
+        self.in_flight[dc_msg.id] = token
+        try:
+            if not self.model.loaded.is_set():
+                await log_and_send(dc_msg.channel, f"The model is still loading: {self.model.status()}. " + \
+                                   "Your message is queued and will be answered once it is ready.")
+            position = self.admission.position(ticket)
+            if position:
+                await log_and_send(dc_msg.channel, f"Busy, queued at position {position}. " + \
+                                   f"React {CANCEL_EMOJI} or send \"!Cancel\" to withdraw.")
+            async with self.admission.admit(ticket, token):
+                await self.serve(dc_msg, token)
+        except GenerationCancelled as ex:
+            await log_and_send(dc_msg.channel, f"Request stopped: {ex.reason}")
+        except ModelLoadFailed as ex:
+            await log_and_send(dc_msg.channel, str(ex), logging.ERROR)
+        except WorkerCrashed as ex:
+            await log_and_send(dc_msg.channel, f"{ex} It will be restarted for the next request.", logging.ERROR)
+        except WorkerError as ex:
+            await log_and_send(dc_msg.channel, f"The model failed to answer: {ex}", logging.ERROR)
+        finally:
+            # Also covers failures before `admit` is entered, e.g. sending the position notice
+            self.admission.release(ticket)
+            self.in_flight.pop(dc_msg.id, None)
+
+    async def serve(self, dc_msg: discord.message.Message, token: CancelToken) -> None:
+        message = dc_msg.content
+
+        if self.backend in VLLM_DOCKER_BACKENDS and message in LIFECYCLE_COMMANDS:
+            # The commands probe the server through the model, which must not block the event loop
+            await self.model.wait_ready(token)
             if message == "!Start":
                 await start_docker(self.model, dc_msg.channel)
                 return
@@ -251,22 +415,39 @@ class DiscordBot(discord.Client):
                 await stop_docker(self.model, dc_msg.channel)
                 return
 
-        if type(self.model) is not VllmDockerQwenAgent:
-            response = self.model(dc_msg.content)
-            MAIN_LOGGER.debug(f"Generated response: \"{response}\".")
-            msg = await dc_msg.channel.send(response)
-            response_pruned = response[:20] + "..." if len(response) > 20 else response
-            MAIN_LOGGER.info(f"Replied: \"{response_pruned}\".")
+        if dc_msg.attachments:
+            if self.backend not in AGENT_BACKENDS:
+                await log_and_send(dc_msg.channel, "Attachments are only used by the agent backends, ignored.",
+                                   logging.WARNING)
+            else:
+                # Created on first upload, so other backends do not get a projects directory
+                if self.ingester is None: self.ingester = AttachmentIngester()
+                # Files go to disk, the agent only gets their listing and reads what it needs
+                manifest = await self.ingester.ingest(dc_msg.attachments)
+                token.raise_if_cancelled()
+                await log_and_send(dc_msg.channel, manifest.summary())
+                if not manifest.files and not message.strip(): return
+                message = f"{message}\n\n{manifest.render()}".strip()
+
+        start = time.perf_counter()
+        if self.backend in AGENT_BACKENDS:
+            # Each channel is its own conversation
+            response = await self.generate(token, message, conversation=str(dc_msg.channel.id))
         else:
-            response_list = self.model(dc_msg.content)
-            response_list = process_qwen_response_list(response_list)
-            for role, content in response_list:
-                split_messages = split_message(f"# {role}:\n{content}")
-                for message in split_messages:
-                    msg = await dc_msg.channel.send(message)
-                    time.sleep(1)
-                content_pruned = content[:20] + "..." if len(content) > 20 else content
-                MAIN_LOGGER.info(f"Replied: \"{content_pruned}\".")
+            response = await self.generate(token, message)
+        generated = time.perf_counter()
+
+        if self.backend not in AGENT_BACKENDS:
+            sections = [ (None, str(response)) ]
+        else:
+            sections = process_qwen_response_list(response)
+        sent_num = await self.delivery.deliver(dc_msg.channel, sections)
+        MAIN_LOGGER.info(f"Replied with {sent_num} message(s).", extra={
+            "generate_secs": round(generated - start, 3),
+            "deliver_secs" : round(time.perf_counter() - generated, 3),
+            "reply_chars"  : sum(len(content) for _, content in sections),
+            "payload"      : sections[-1][1] if sections else None,
+        })
 
 
 
@@ -274,7 +455,12 @@ class DiscordBot(discord.Client):
 
 ##### Execution #####
 if __name__ == "__main__":
-    # model: VllmDockerLcModel = VllmDockerLcModel(MODEL_NAME, MAX_MODEL_LEN, VLLM_PORT)
-    model: VllmDockerQwenAgent = VllmDockerQwenAgent(MODEL_NAME, VLLM_PORT)
-    bot = DiscordBot(model=model, intents=discord.Intents.default())
-    bot.run(DISCORD_TOKEN)
\ No newline at end of file
+    # Load in the background so the bot is online within seconds
+    model = start_model(BACKEND, profile=STARTUP)
+    bot = DiscordBot(model=model, backend=BACKEND, intents=discord.Intents.default())
+    try:
+        # Its records already go through libs/logs.py, so discord.py should not add a handler
+        bot.run(DISCORD_TOKEN, log_handler=None)
+    finally:
+        # Inference workers left running would hold up the exit
+        model.close()